@@ -1,3 +1,16 @@
+import hashlib
+import hmac
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from instrument import stage, timed
+
 s_box = (
     0x63, 0x7C, 0x77, 0x7B, 0xF2, 0x6B, 0x6F, 0xC5, 0x30, 0x01, 0x67, 0x2B, 0xFE, 0xD7, 0xAB, 0x76,
     0xCA, 0x82, 0xC9, 0x7D, 0xFA, 0x59, 0x47, 0xF0, 0xAD, 0xD4, 0xA2, 0xAF, 0x9C, 0xA4, 0x72, 0xC0,
@@ -107,6 +120,104 @@ r_con = (
 )
 
 
+def gf_mul(a, b):
+    """ Multiplies two bytes in GF(2^8) with the AES polynomial.  """
+    r = 0
+    while b:
+        if b & 1:
+            r ^= a
+        a = xtime(a)
+        b >>= 1
+    return r
+
+
+def _ror8(word):
+    return ((word >> 8) | (word << 24)) & 0xFFFFFFFF
+
+
+def _build_t_tables(box, coefficients):
+    """
+    Builds the four 256-entry T-tables that fold SubBytes (with `box`) and
+    the MixColumns column multiplication by `coefficients` into a single
+    lookup per byte. Columns are big-endian 32-bit words.
+    """
+    c0, c1, c2, c3 = coefficients
+    t0 = tuple(
+        (gf_mul(v, c0) << 24) | (gf_mul(v, c1) << 16) | (gf_mul(v, c2) << 8) | gf_mul(v, c3)
+        for v in box
+    )
+    t1 = tuple(_ror8(w) for w in t0)
+    t2 = tuple(_ror8(w) for w in t1)
+    t3 = tuple(_ror8(w) for w in t2)
+    return t0, t1, t2, t3
+
+
+# see Sec 4.2 in The Design of Rijndael
+Te0, Te1, Te2, Te3 = _build_t_tables(s_box, (2, 1, 1, 3))
+Td0, Td1, Td2, Td3 = _build_t_tables(inv_s_box, (14, 9, 13, 11))
+
+
+def inv_mix_column_word(w):
+    """ Applies InvMixColumns to a single big-endian column word.  """
+    return (Td0[s_box[w >> 24]] ^ Td1[s_box[(w >> 16) & 0xFF]] ^
+            Td2[s_box[(w >> 8) & 0xFF]] ^ Td3[s_box[w & 0xFF]])
+
+
+# Same tables as NumPy arrays, for the batched engine.
+np_s_box = np.array(s_box, dtype=np.uint32)
+np_te = tuple(np.array(t, dtype=np.uint32) for t in (Te0, Te1, Te2, Te3))
+np_inv_s_box = np.array(inv_s_box, dtype=np.uint32)
+np_td = tuple(np.array(t, dtype=np.uint32) for t in (Td0, Td1, Td2, Td3))
+
+# Number of counter blocks encrypted per batch in CTR mode (1 MiB of keystream).
+CTR_BATCH_BLOCKS = 65536
+
+
+def ctr_counter_words(iv, start, count):
+    """
+    Returns a (count, 4) uint32 array with the big-endian column words of the
+    counter blocks `iv + start` .. `iv + start + count - 1` (mod 2^128).
+    """
+    value = (int.from_bytes(iv, 'big') + start) % (1 << 128)
+    hi = np.uint64(value >> 64)
+    lo = np.uint64(value & 0xFFFFFFFFFFFFFFFF)
+    low = lo + np.arange(count, dtype=np.uint64)
+    # Carry into the high half where the low half wrapped around.
+    high = hi + (low < lo).astype(np.uint64)
+    words = np.empty((count, 4), dtype=np.uint32)
+    words[:, 0] = high >> np.uint64(32)
+    words[:, 1] = high & np.uint64(0xFFFFFFFF)
+    words[:, 2] = low >> np.uint64(32)
+    words[:, 3] = low & np.uint64(0xFFFFFFFF)
+    return words
+
+
+# Default chunk size handed to each worker by the parallel CTR mode (4 MiB).
+CTR_PARALLEL_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Default read size for streaming file encryption (1 MiB).
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Per-process state for the parallel CTR workers, set once by the pool initializer.
+_ctr_worker = {}
+
+
+def _ctr_worker_init(n_rounds, enc_round_keys, shm_name, iv):
+    _ctr_worker['cipher'] = AES.from_schedule(n_rounds, enc_round_keys)
+    _ctr_worker['shm'] = shared_memory.SharedMemory(name=shm_name)
+    _ctr_worker['iv'] = iv
+
+
+def _ctr_worker_xor(offset, length):
+    """ XORs the keystream into `length` bytes of the shared buffer at `offset`.  """
+    cipher = _ctr_worker['cipher']
+    data = np.ndarray((length,), dtype=np.uint8, buffer=_ctr_worker['shm'].buf, offset=offset)
+    keystream = cipher.ctr_keystream(_ctr_worker['iv'], offset // 16, (length + 15) // 16)
+    np.bitwise_xor(data, keystream[:length], out=data)
+    del data
+    return length
+
+
 def bytes2matrix(text):
     """ Converts a 16-byte array into a 4x4 matrix.  """
     return [list(text[i:i + 4]) for i in range(0, len(text), 4)]
@@ -157,14 +268,259 @@ def unpad(plaintext):
     return message
 
 
+def checked_unpad(plaintext, block_size=16):
+    """
+    Same as `unpad` for untrusted input: raises ValueError instead of
+    asserting, so the check also runs under `python -O`.
+    """
+    if not plaintext or len(plaintext) % block_size:
+        raise ValueError('invalid PKCS#7 padding')
+    padding_len = plaintext[-1]
+    if not 0 < padding_len <= block_size or any(p != padding_len for p in plaintext[-padding_len:]):
+        raise ValueError('invalid PKCS#7 padding')
+    return plaintext[:-padding_len]
+
+
+def _check_cbc_input(ciphertext, iv):
+    if len(iv) != 16:
+        raise ValueError('CBC IV must be 16 bytes')
+    if not len(ciphertext) or len(ciphertext) % 16:
+        raise ValueError('CBC ciphertext length must be a positive multiple of 16')
+
+
 def split_blocks(message, block_size=16, require_padding=True):
     assert len(message) % block_size == 0 or not require_padding
     return [message[i:i + 16] for i in range(0, len(message), block_size)]
 
 
+# GHASH reduction constant R = 11100001 || 0^120 (bit-reflected, Sec 6.3 of SP 800-38D).
+GCM_R = 0xE1 << 120
+
+# Blocks folded per Horner step in bulk GHASH; one 8-bit table per power of H.
+GHASH_STRIDE = 16
+
+
+def gf128_mul(x, y):
+    """ Multiplies two GCM field elements (128-bit ints, bit-reflected), bit by bit.  """
+    z = 0
+    v = y
+    for i in range(127, -1, -1):
+        if (x >> i) & 1:
+            z ^= v
+        v = (v >> 1) ^ GCM_R if v & 1 else v >> 1
+    return z
+
+
+def gcm_counter_words(j0, start, count):
+    """
+    Returns a (count, 4) uint32 array with the GCM counter blocks
+    inc32^(start)(j0) .. inc32^(start + count - 1)(j0). Only the last 32 bits
+    of the block count, wrapping mod 2^32.
+    """
+    words = np.empty((count, 4), dtype=np.uint32)
+    for i in range(3):
+        words[:, i] = int.from_bytes(j0[4 * i:4 * i + 4], 'big')
+    low = int.from_bytes(j0[12:16], 'big') + start
+    words[:, 3] = (np.arange(count, dtype=np.uint64) + np.uint64(low)) & np.uint64(0xFFFFFFFF)
+    return words
+
+
+class GHash:
+    """
+    GHASH with per-key 8-bit Shoup tables: for every power H^1..H^stride the
+    products of each byte value at each of the 16 block positions are
+    precomputed, so one field multiplication is 16 lookups. Bulk input is
+    folded `stride` blocks at a time,
+        Y' = Y * H^k ^ X_1 * H^k ^ X_2 * H^(k-1) ^ ... ^ X_k * H,
+    with the inner sum computed for all groups at once in NumPy.
+    """
+
+    def __init__(self, h, stride=GHASH_STRIDE):
+        self.stride = stride
+        powers = [h]
+        for _ in range(stride - 1):
+            powers.append(gf128_mul(powers[-1], h))
+        # tables[j] holds the products with H^(stride - j), matching block j of a group.
+        self._hi = np.empty((stride, 16, 256), dtype=np.uint64)
+        self._lo = np.empty((stride, 16, 256), dtype=np.uint64)
+        for j, power in enumerate(reversed(powers)):
+            self._hi[j], self._lo[j] = self._byte_tables(power)
+        self._mul_h = self._int_table(stride - 1)
+        self._mul_hk = self._int_table(0)
+
+    @staticmethod
+    def _byte_tables(h):
+        """ Returns (hi, lo) uint64 arrays of shape (16, 256) with byte b at position p times h. """
+        basis = []
+        v = h
+        for _ in range(128):
+            basis.append(v)
+            v = (v >> 1) ^ GCM_R if v & 1 else v >> 1
+        basis_hi = np.array([b >> 64 for b in basis], dtype=np.uint64).reshape(16, 8)
+        basis_lo = np.array([b & 0xFFFFFFFFFFFFFFFF for b in basis], dtype=np.uint64).reshape(16, 8)
+        values = np.arange(256)
+        hi = np.zeros((16, 256), dtype=np.uint64)
+        lo = np.zeros((16, 256), dtype=np.uint64)
+        for t in range(8):
+            # Bit t counts from the most significant bit of the byte.
+            mask = ((values >> (7 - t)) & 1).astype(bool)
+            hi[:, mask] ^= basis_hi[:, t:t + 1]
+            lo[:, mask] ^= basis_lo[:, t:t + 1]
+        return hi, lo
+
+    def _int_table(self, j):
+        return [[(int(hi) << 64) | int(lo) for hi, lo in zip(self._hi[j, p], self._lo[j, p])] for p in range(16)]
+
+    @staticmethod
+    def _mul(y, table):
+        r = 0
+        for p in range(16):
+            r ^= table[p][(y >> (120 - 8 * p)) & 0xFF]
+        return r
+
+    def update(self, y, data):
+        """
+        Absorbs `data` (a multiple of 16 bytes) into the GHASH state `y`
+        and returns the new state.
+        """
+        blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, 16)
+        k = self.stride
+        n_groups = len(blocks) // k
+        if n_groups:
+            groups = blocks[:n_groups * k].reshape(n_groups, k, 16)
+            power = np.arange(k)[None, :, None]
+            position = np.arange(16)[None, None, :]
+            sums_hi = np.bitwise_xor.reduce(self._hi[power, position, groups].reshape(n_groups, -1), axis=1)
+            sums_lo = np.bitwise_xor.reduce(self._lo[power, position, groups].reshape(n_groups, -1), axis=1)
+            mul, table = self._mul, self._mul_hk
+            for hi, lo in zip(sums_hi.tolist(), sums_lo.tolist()):
+                y = mul(y, table) ^ ((hi << 64) | lo)
+
+        table = self._mul_h
+        for block in blocks[n_groups * k:]:
+            y = self._mul(y ^ int.from_bytes(block.tobytes(), 'big'), table)
+        return y
+
+    def digest(self, associated_data, ciphertext):
+        """ Returns GHASH(A || pad || C || pad || len(A) || len(C)) as an int.  """
+        y = 0
+        for part in (associated_data, ciphertext):
+            if len(part):
+                y = self._update_chunked(y, part)
+        lengths = (len(associated_data) * 8).to_bytes(8, 'big') + (len(ciphertext) * 8).to_bytes(8, 'big')
+        return self.update(y, lengths)
+
+    def _update_chunked(self, y, data):
+        """ Absorbs `data` zero padded to a whole block, in bounded-size chunks. """
+        view = memoryview(data).cast('B')
+        chunk = CTR_BATCH_BLOCKS * 16
+        full = len(view) - len(view) % 16
+        for offset in range(0, full, chunk):
+            y = self.update(y, view[offset:min(offset + chunk, full)])
+        if full < len(view):
+            y = self.update(y, bytes(view[full:]) + bytes(16 - len(view) + full))
+        return y
+
+    def zeroize(self):
+        self._hi.fill(0)
+        self._lo.fill(0)
+        for table in (self._mul_h, self._mul_hk):
+            table.clear()
+
+
+class KeyScheduleCache:
+    """
+    Bounded LRU cache of expanded AES key schedules, keyed by the SHA-256 of
+    the master key so the raw key is never kept as a dict key. Cached
+    schedules are shared by every `AES` object built from the same key.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(master_key):
+        return hashlib.sha256(bytes(master_key)).digest()
+
+    def get(self, master_key, expand):
+        """
+        Returns the schedule for `master_key`, calling `expand()` to build it
+        on a miss. The least recently used entry is dropped past `maxsize`;
+        only `evict` and `clear` zeroize.
+        """
+        digest = self._digest(master_key)
+        with self._lock:
+            schedule = self._entries.get(digest)
+            if schedule is not None:
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return schedule
+            self.misses += 1
+
+        schedule = expand()
+        if self.maxsize <= 0:
+            return schedule
+        with self._lock:
+            self._entries[digest] = schedule
+            self._entries.move_to_end(digest)
+            # Overflow entries are only dropped, since live AES objects may still use them.
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return schedule
+
+    def evict(self, master_key):
+        """
+        Drops and zeroizes the schedule of `master_key`. AES objects already
+        built from it raise ValueError when used afterwards.
+        """
+        with self._lock:
+            schedule = self._entries.pop(self._digest(master_key), None)
+        if schedule is not None:
+            self._zeroize(schedule)
+        return schedule is not None
+
+    def clear(self):
+        """ Drops and zeroizes every cached schedule. """
+        with self._lock:
+            entries, self._entries = self._entries, OrderedDict()
+        for schedule in entries.values():
+            self._zeroize(schedule)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+    @staticmethod
+    def _zeroize(schedule):
+        """
+        Overwrites the mutable parts of a schedule, then drops every entry and
+        marks it zeroized so AES objects sharing it refuse to run. Python ints
+        cannot be wiped in place, so this is best effort for the word lists.
+        """
+        for value in schedule.values():
+            if isinstance(value, GHash):
+                value.zeroize()
+            elif isinstance(value, np.ndarray):
+                value.fill(0)
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, list):
+                        item.clear()
+                value.clear()
+        for name in schedule:
+            schedule[name] = None
+        schedule['zeroized'] = True
+
+
+schedule_cache = KeyScheduleCache()
+
+
 class AES:
     """
-    Class for AES-128 encryption with CBC mode and PKCS#7.
+    Class for AES-128/192/256 encryption with CTR, GCM and CBC (PKCS#7) modes.
     This is a raw implementation of AES, without key stretching or IV
     management. Unless you need that, please use `encrypt` and `decrypt`.
     """
@@ -176,7 +532,59 @@ class AES:
         """
         assert len(master_key) in AES.rounds_by_key_size
         self.n_rounds = AES.rounds_by_key_size[len(master_key)]
-        self._key_matrices = self._expand_key(master_key)
+        schedule = schedule_cache.get(master_key, lambda: self._build_schedule(master_key))
+        self._schedule = schedule
+        self._key_matrices = schedule['key_matrices']
+        self._enc_round_keys = schedule['enc_round_keys']
+        self._dec_round_keys = schedule['dec_round_keys']
+        self._np_enc_round_keys = schedule['np_enc_round_keys']
+        self._np_dec_round_keys = schedule['np_dec_round_keys']
+
+    def _build_schedule(self, master_key):
+        """
+        Expands `master_key` and precomputes the round key words used by the
+        block and batch engines.
+        """
+        with stage('aes.key_expansion'):
+            key_matrices = self._expand_key(master_key)
+            enc_round_keys, dec_round_keys = self._round_key_words(key_matrices)
+        return {
+            'key_matrices': key_matrices,
+            'enc_round_keys': enc_round_keys,
+            'dec_round_keys': dec_round_keys,
+            'np_enc_round_keys': np.array(enc_round_keys, dtype=np.uint32),
+            'np_dec_round_keys': np.array(dec_round_keys, dtype=np.uint32),
+        }
+
+    @classmethod
+    def from_schedule(cls, n_rounds, enc_round_keys):
+        """
+        Builds an encrypt-only cipher from an already expanded schedule of
+        round key words, skipping key expansion. Used to hand the schedule
+        to worker processes without the master key.
+        """
+        cipher = cls.__new__(cls)
+        cipher.n_rounds = n_rounds
+        cipher._np_enc_round_keys = np.asarray(enc_round_keys, dtype=np.uint32)
+        cipher._schedule = {'np_enc_round_keys': cipher._np_enc_round_keys}
+        cipher._enc_round_keys = [tuple(int(w) for w in round_key) for round_key in cipher._np_enc_round_keys]
+        return cipher
+
+    @staticmethod
+    def _round_key_words(key_matrices):
+        """
+        Converts the key matrices into per-round tuples of four column words
+        for the T-table engine. Decryption keys are returned in reverse order
+        with InvMixColumns applied to the inner rounds (equivalent inverse
+        cipher, Sec 5.3.5 of FIPS-197).
+        """
+        enc = [tuple(int.from_bytes(bytes(column), 'big') for column in matrix)
+               for matrix in key_matrices]
+        dec = [enc[-1]]
+        dec.extend(tuple(inv_mix_column_word(w) for w in round_key)
+                   for round_key in reversed(enc[1:-1]))
+        dec.append(enc[0])
+        return enc, dec
 
     def _expand_key(self, master_key):
         """
@@ -212,12 +620,91 @@ class AES:
         # Group key words in 4x4 byte matrices.
         return [key_columns[4 * i: 4 * (i + 1)] for i in range(len(key_columns) // 4)]
 
+    def _round_keys(self, name):
+        """
+        Returns the key schedule attribute `name`, raising ValueError if the
+        shared schedule has since been zeroized by `schedule_cache`.
+        """
+        if self._schedule.get('zeroized'):
+            raise ValueError('AES key schedule was evicted and zeroized; create a new AES object')
+        return getattr(self, name)
+
+    @timed('aes.encrypt_block')
     def encrypt_block(self, plaintext):
         """
         Encrypts a single block of 16 byte long plaintext.
         """
         assert len(plaintext) == 16
 
+        round_keys = self._round_keys('_enc_round_keys')
+        k0, k1, k2, k3 = round_keys[0]
+        s0 = int.from_bytes(plaintext[0:4], 'big') ^ k0
+        s1 = int.from_bytes(plaintext[4:8], 'big') ^ k1
+        s2 = int.from_bytes(plaintext[8:12], 'big') ^ k2
+        s3 = int.from_bytes(plaintext[12:16], 'big') ^ k3
+
+        t0, t1, t2, t3 = Te0, Te1, Te2, Te3
+        for i in range(1, self.n_rounds):
+            k0, k1, k2, k3 = round_keys[i]
+            s0, s1, s2, s3 = (
+                t0[s0 >> 24] ^ t1[(s1 >> 16) & 0xFF] ^ t2[(s2 >> 8) & 0xFF] ^ t3[s3 & 0xFF] ^ k0,
+                t0[s1 >> 24] ^ t1[(s2 >> 16) & 0xFF] ^ t2[(s3 >> 8) & 0xFF] ^ t3[s0 & 0xFF] ^ k1,
+                t0[s2 >> 24] ^ t1[(s3 >> 16) & 0xFF] ^ t2[(s0 >> 8) & 0xFF] ^ t3[s1 & 0xFF] ^ k2,
+                t0[s3 >> 24] ^ t1[(s0 >> 16) & 0xFF] ^ t2[(s1 >> 8) & 0xFF] ^ t3[s2 & 0xFF] ^ k3,
+            )
+
+        # Final round has no MixColumns.
+        sb = s_box
+        k0, k1, k2, k3 = round_keys[-1]
+        return b''.join((
+            ((sb[s0 >> 24] << 24 | sb[(s1 >> 16) & 0xFF] << 16 | sb[(s2 >> 8) & 0xFF] << 8 | sb[s3 & 0xFF]) ^ k0).to_bytes(4, 'big'),
+            ((sb[s1 >> 24] << 24 | sb[(s2 >> 16) & 0xFF] << 16 | sb[(s3 >> 8) & 0xFF] << 8 | sb[s0 & 0xFF]) ^ k1).to_bytes(4, 'big'),
+            ((sb[s2 >> 24] << 24 | sb[(s3 >> 16) & 0xFF] << 16 | sb[(s0 >> 8) & 0xFF] << 8 | sb[s1 & 0xFF]) ^ k2).to_bytes(4, 'big'),
+            ((sb[s3 >> 24] << 24 | sb[(s0 >> 16) & 0xFF] << 16 | sb[(s1 >> 8) & 0xFF] << 8 | sb[s2 & 0xFF]) ^ k3).to_bytes(4, 'big'),
+        ))
+
+    @timed('aes.decrypt_block')
+    def decrypt_block(self, ciphertext):
+        """
+        Decrypts a single block of 16 byte long ciphertext.
+        """
+        assert len(ciphertext) == 16
+
+        round_keys = self._round_keys('_dec_round_keys')
+        k0, k1, k2, k3 = round_keys[0]
+        s0 = int.from_bytes(ciphertext[0:4], 'big') ^ k0
+        s1 = int.from_bytes(ciphertext[4:8], 'big') ^ k1
+        s2 = int.from_bytes(ciphertext[8:12], 'big') ^ k2
+        s3 = int.from_bytes(ciphertext[12:16], 'big') ^ k3
+
+        t0, t1, t2, t3 = Td0, Td1, Td2, Td3
+        for i in range(1, self.n_rounds):
+            k0, k1, k2, k3 = round_keys[i]
+            s0, s1, s2, s3 = (
+                t0[s0 >> 24] ^ t1[(s3 >> 16) & 0xFF] ^ t2[(s2 >> 8) & 0xFF] ^ t3[s1 & 0xFF] ^ k0,
+                t0[s1 >> 24] ^ t1[(s0 >> 16) & 0xFF] ^ t2[(s3 >> 8) & 0xFF] ^ t3[s2 & 0xFF] ^ k1,
+                t0[s2 >> 24] ^ t1[(s1 >> 16) & 0xFF] ^ t2[(s0 >> 8) & 0xFF] ^ t3[s3 & 0xFF] ^ k2,
+                t0[s3 >> 24] ^ t1[(s2 >> 16) & 0xFF] ^ t2[(s1 >> 8) & 0xFF] ^ t3[s0 & 0xFF] ^ k3,
+            )
+
+        # Final round has no InvMixColumns.
+        sb = inv_s_box
+        k0, k1, k2, k3 = round_keys[-1]
+        return b''.join((
+            ((sb[s0 >> 24] << 24 | sb[(s3 >> 16) & 0xFF] << 16 | sb[(s2 >> 8) & 0xFF] << 8 | sb[s1 & 0xFF]) ^ k0).to_bytes(4, 'big'),
+            ((sb[s1 >> 24] << 24 | sb[(s0 >> 16) & 0xFF] << 16 | sb[(s3 >> 8) & 0xFF] << 8 | sb[s2 & 0xFF]) ^ k1).to_bytes(4, 'big'),
+            ((sb[s2 >> 24] << 24 | sb[(s1 >> 16) & 0xFF] << 16 | sb[(s0 >> 8) & 0xFF] << 8 | sb[s3 & 0xFF]) ^ k2).to_bytes(4, 'big'),
+            ((sb[s3 >> 24] << 24 | sb[(s2 >> 16) & 0xFF] << 16 | sb[(s1 >> 8) & 0xFF] << 8 | sb[s0 & 0xFF]) ^ k3).to_bytes(4, 'big'),
+        ))
+
+    def encrypt_block_reference(self, plaintext):
+        """
+        Encrypts a single block of 16 byte long plaintext with the
+        byte-matrix implementation. Kept as the reference for `encrypt_block`.
+        """
+        assert len(plaintext) == 16
+        self._round_keys('_key_matrices')
+
         plain_state = bytes2matrix(plaintext)
 
         add_round_key(plain_state, self._key_matrices[0])
@@ -234,11 +721,13 @@ class AES:
 
         return matrix2bytes(plain_state)
 
-    def decrypt_block(self, ciphertext):
+    def decrypt_block_reference(self, ciphertext):
         """
-        Decrypts a single block of 16 byte long ciphertext.
+        Decrypts a single block of 16 byte long ciphertext with the
+        byte-matrix implementation. Kept as the reference for `decrypt_block`.
         """
         assert len(ciphertext) == 16
+        self._round_keys('_key_matrices')
 
         cipher_state = bytes2matrix(ciphertext)
 
@@ -256,9 +745,366 @@ class AES:
 
         return matrix2bytes(cipher_state)
 
-    def encrypt_ctr(self, plaintext, iv):
+    def encrypt_words(self, words):
+        """
+        Encrypts a (N, 4) uint32 array of big-endian column words, one block
+        per row, running every round over the whole batch.
+        """
+        te0, te1, te2, te3 = np_te
+        round_keys = self._round_keys('_np_enc_round_keys')
+        s0 = words[:, 0] ^ round_keys[0, 0]
+        s1 = words[:, 1] ^ round_keys[0, 1]
+        s2 = words[:, 2] ^ round_keys[0, 2]
+        s3 = words[:, 3] ^ round_keys[0, 3]
+
+        for i in range(1, self.n_rounds):
+            k0, k1, k2, k3 = round_keys[i]
+            s0, s1, s2, s3 = (
+                te0[s0 >> 24] ^ te1[(s1 >> 16) & 0xFF] ^ te2[(s2 >> 8) & 0xFF] ^ te3[s3 & 0xFF] ^ k0,
+                te0[s1 >> 24] ^ te1[(s2 >> 16) & 0xFF] ^ te2[(s3 >> 8) & 0xFF] ^ te3[s0 & 0xFF] ^ k1,
+                te0[s2 >> 24] ^ te1[(s3 >> 16) & 0xFF] ^ te2[(s0 >> 8) & 0xFF] ^ te3[s1 & 0xFF] ^ k2,
+                te0[s3 >> 24] ^ te1[(s0 >> 16) & 0xFF] ^ te2[(s1 >> 8) & 0xFF] ^ te3[s2 & 0xFF] ^ k3,
+            )
+
+        # Final round has no MixColumns.
+        sb = np_s_box
+        k0, k1, k2, k3 = round_keys[-1]
+        out = np.empty_like(words)
+        out[:, 0] = (sb[s0 >> 24] << 24 | sb[(s1 >> 16) & 0xFF] << 16 | sb[(s2 >> 8) & 0xFF] << 8 | sb[s3 & 0xFF]) ^ k0
+        out[:, 1] = (sb[s1 >> 24] << 24 | sb[(s2 >> 16) & 0xFF] << 16 | sb[(s3 >> 8) & 0xFF] << 8 | sb[s0 & 0xFF]) ^ k1
+        out[:, 2] = (sb[s2 >> 24] << 24 | sb[(s3 >> 16) & 0xFF] << 16 | sb[(s0 >> 8) & 0xFF] << 8 | sb[s1 & 0xFF]) ^ k2
+        out[:, 3] = (sb[s3 >> 24] << 24 | sb[(s0 >> 16) & 0xFF] << 16 | sb[(s1 >> 8) & 0xFF] << 8 | sb[s2 & 0xFF]) ^ k3
+        return out
+
+    def decrypt_words(self, words):
+        """
+        Decrypts a (N, 4) uint32 array of big-endian column words, one block
+        per row, running every round over the whole batch.
+        """
+        td0, td1, td2, td3 = np_td
+        round_keys = self._round_keys('_np_dec_round_keys')
+        s0 = words[:, 0] ^ round_keys[0, 0]
+        s1 = words[:, 1] ^ round_keys[0, 1]
+        s2 = words[:, 2] ^ round_keys[0, 2]
+        s3 = words[:, 3] ^ round_keys[0, 3]
+
+        for i in range(1, self.n_rounds):
+            k0, k1, k2, k3 = round_keys[i]
+            s0, s1, s2, s3 = (
+                td0[s0 >> 24] ^ td1[(s3 >> 16) & 0xFF] ^ td2[(s2 >> 8) & 0xFF] ^ td3[s1 & 0xFF] ^ k0,
+                td0[s1 >> 24] ^ td1[(s0 >> 16) & 0xFF] ^ td2[(s3 >> 8) & 0xFF] ^ td3[s2 & 0xFF] ^ k1,
+                td0[s2 >> 24] ^ td1[(s1 >> 16) & 0xFF] ^ td2[(s0 >> 8) & 0xFF] ^ td3[s3 & 0xFF] ^ k2,
+                td0[s3 >> 24] ^ td1[(s2 >> 16) & 0xFF] ^ td2[(s1 >> 8) & 0xFF] ^ td3[s0 & 0xFF] ^ k3,
+            )
+
+        # Final round has no InvMixColumns.
+        sb = np_inv_s_box
+        k0, k1, k2, k3 = round_keys[-1]
+        out = np.empty_like(words)
+        out[:, 0] = (sb[s0 >> 24] << 24 | sb[(s3 >> 16) & 0xFF] << 16 | sb[(s2 >> 8) & 0xFF] << 8 | sb[s1 & 0xFF]) ^ k0
+        out[:, 1] = (sb[s1 >> 24] << 24 | sb[(s0 >> 16) & 0xFF] << 16 | sb[(s3 >> 8) & 0xFF] << 8 | sb[s2 & 0xFF]) ^ k1
+        out[:, 2] = (sb[s2 >> 24] << 24 | sb[(s1 >> 16) & 0xFF] << 16 | sb[(s0 >> 8) & 0xFF] << 8 | sb[s3 & 0xFF]) ^ k2
+        out[:, 3] = (sb[s3 >> 24] << 24 | sb[(s2 >> 16) & 0xFF] << 16 | sb[(s1 >> 8) & 0xFF] << 8 | sb[s0 & 0xFF]) ^ k3
+        return out
+
+    def ctr_keystream(self, iv, start_block, n_blocks):
+        """
+        Returns `n_blocks * 16` bytes of CTR keystream as a uint8 array,
+        starting at counter block `iv + start_block`.
+        """
+        assert len(iv) == 16
+        with stage('aes.keystream', n_bytes=n_blocks * 16):
+            words = self.encrypt_words(ctr_counter_words(iv, start_block, n_blocks))
+            return words.astype('>u4').view(np.uint8).reshape(-1)
+
+    def encrypt_cbc(self, plaintext, iv):
+        """
+        Encrypts `plaintext` using CBC mode and PKCS#7 padding.
+        Each block depends on the previous ciphertext, so this is serial.
+        """
+        assert len(iv) == 16
+
+        plaintext = pad(plaintext)
+
+        blocks = []
+        previous = iv
+        for plaintext_block in split_blocks(plaintext):
+            # CBC mode encrypt: encrypt(plaintext_block XOR previous)
+            block = self.encrypt_block(xor_bytes(plaintext_block, previous))
+            blocks.append(block)
+            previous = block
+
+        return b''.join(blocks)
+
+    def decrypt_cbc(self, ciphertext, iv):
+        """
+        Decrypts `ciphertext` using CBC mode and PKCS#7 padding. Every block
+        only needs its own and the previous ciphertext block, so all blocks
+        of a batch are decrypted at once and XORed with the ciphertext
+        shifted by one block. Raises ValueError for a bad length or padding.
+        """
+        _check_cbc_input(ciphertext, iv)
+
+        data = np.frombuffer(ciphertext, dtype=np.uint8)
+        words = data.view('>u4').reshape(-1, 4)
+        out = np.empty_like(data)
+        batch_blocks = CTR_BATCH_BLOCKS
+        for start in range(0, len(words), batch_blocks):
+            stop = min(start + batch_blocks, len(words))
+            with stage('aes.decrypt_words', n_bytes=(stop - start) * 16):
+                plain = self.decrypt_words(words[start:stop].astype(np.uint32))
+            plain = plain.astype('>u4').view(np.uint8).reshape(-1)
+            # CBC mode decrypt: decrypt(block) XOR previous ciphertext block
+            if start:
+                previous = data[(start - 1) * 16:(stop - 1) * 16]
+            else:
+                previous = np.concatenate([np.frombuffer(iv, dtype=np.uint8), data[:(stop - 1) * 16]])
+            with stage('aes.xor', n_bytes=len(plain)):
+                np.bitwise_xor(plain, previous, out=out[start * 16:stop * 16])
+
+        return checked_unpad(out.tobytes())
+
+    def decrypt_cbc_reference(self, ciphertext, iv):
+        """
+        Decrypts `ciphertext` using CBC mode one block at a time. Kept as the
+        reference for `decrypt_cbc`.
+        """
+        _check_cbc_input(ciphertext, iv)
+
+        blocks = []
+        previous = iv
+        for ciphertext_block in split_blocks(ciphertext):
+            # CBC mode decrypt: previous XOR decrypt(ciphertext)
+            blocks.append(xor_bytes(previous, self.decrypt_block_reference(ciphertext_block)))
+            previous = ciphertext_block
+
+        return checked_unpad(b''.join(blocks))
+
+    def encrypt_ctr(self, plaintext, iv, progress=None):
         """
         Encrypts `plaintext` using CTR mode with the given nounce/IV.
+        The keystream is generated in batches of `CTR_BATCH_BLOCKS` blocks;
+        `progress(done_bytes, total_bytes)` is called after each batch.
+        """
+        assert len(iv) == 16
+
+        data = np.frombuffer(plaintext, dtype=np.uint8)
+        out = np.empty_like(data)
+        batch_bytes = CTR_BATCH_BLOCKS * 16
+        for offset in range(0, len(data), batch_bytes):
+            chunk = data[offset:offset + batch_bytes]
+            keystream = self.ctr_keystream(iv, offset // 16, (len(chunk) + 15) // 16)
+            with stage('aes.xor', n_bytes=len(chunk)):
+                np.bitwise_xor(chunk, keystream[:len(chunk)], out=out[offset:offset + len(chunk)])
+            if progress:
+                progress(offset + len(chunk), len(data))
+
+        return out.tobytes()
+
+    def decrypt_ctr(self, ciphertext, iv, progress=None):
+        """
+        Decrypts `ciphertext` using CTR mode with the given nounce/IV.
+        """
+        return self.encrypt_ctr(ciphertext, iv, progress)
+
+    def encrypt_ctr_parallel(self, plaintext, iv, workers=None, chunk_size=CTR_PARALLEL_CHUNK_SIZE):
+        """
+        Encrypts `plaintext` using CTR mode across `workers` processes.
+        The data is copied once into shared memory and every worker XORs
+        the keystream for its counter-aligned chunk in place, starting at
+        counter `iv + offset // 16`. Output matches `encrypt_ctr`.
+        """
+        assert len(iv) == 16
+        assert chunk_size > 0 and chunk_size % 16 == 0
+
+        workers = workers or os.cpu_count() or 1
+        # Count bytes, not items: len() of an HxWxC image array is its row count.
+        view = memoryview(plaintext).cast('B')
+        if workers == 1 or view.nbytes <= chunk_size:
+            return self.encrypt_ctr(plaintext, iv)
+
+        shm = shared_memory.SharedMemory(create=True, size=view.nbytes)
+        try:
+            shm.buf[:view.nbytes] = view
+            offsets = range(0, view.nbytes, chunk_size)
+            lengths = [min(chunk_size, view.nbytes - offset) for offset in offsets]
+            with ProcessPoolExecutor(max_workers=workers, initializer=_ctr_worker_init,
+                                     initargs=(self.n_rounds, self._round_keys('_np_enc_round_keys'), shm.name, bytes(iv))) as pool:
+                for _ in pool.map(_ctr_worker_xor, offsets, lengths):
+                    pass
+            return bytes(shm.buf[:view.nbytes])
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def decrypt_ctr_parallel(self, ciphertext, iv, workers=None, chunk_size=CTR_PARALLEL_CHUNK_SIZE):
+        """
+        Decrypts `ciphertext` using CTR mode across `workers` processes.
+        """
+        return self.encrypt_ctr_parallel(ciphertext, iv, workers, chunk_size)
+
+    def encrypt_ctr_inplace(self, target, iv, progress=None):
+        """
+        Encrypts `target` in place using CTR mode and returns the number of
+        bytes processed. `target` is either a path (str or os.PathLike),
+        which is memory-mapped, or any writable object supporting the buffer
+        protocol (mmap, bytearray, contiguous numpy array). The keystream is
+        XORed into the buffer one batch window at a time, calling
+        `progress(done, total)` after each.
+        """
+        assert len(iv) == 16
+
+        # bytes is a buffer here, not a path, so read-only ciphertext hits the writable check below.
+        if isinstance(target, (str, os.PathLike)):
+            with open(target, 'r+b') as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    return 0
+                with mmap.mmap(file.fileno(), 0) as mapped:
+                    processed = self.encrypt_ctr_inplace(mapped, iv, progress)
+                    mapped.flush()
+                return processed
+
+        view = memoryview(target).cast('B')
+        assert not view.readonly, 'target buffer must be writable'
+        data = np.frombuffer(view, dtype=np.uint8)
+        window = CTR_BATCH_BLOCKS * 16
+        for offset in range(0, len(data), window):
+            part = data[offset:offset + window]
+            keystream = self.ctr_keystream(iv, offset // 16, (len(part) + 15) // 16)
+            with stage('aes.xor', n_bytes=len(part)):
+                np.bitwise_xor(part, keystream[:len(part)], out=part)
+            if progress:
+                progress(offset + len(part), len(data))
+        return len(data)
+
+    def decrypt_ctr_inplace(self, target, iv, progress=None):
+        """
+        Decrypts `target` in place using CTR mode. See `encrypt_ctr_inplace`.
+        """
+        return self.encrypt_ctr_inplace(target, iv, progress)
+
+    def encrypt_pixels(self, img, iv, progress=None):
+        """
+        Encrypts a decoded pixel array (e.g. uint8 HxWxC) with CTR mode and
+        returns an encrypted array of the same shape and dtype, so it can be
+        previewed or stored without any image codec.
+        """
+        out = np.array(img, order='C', copy=True)
+        self.encrypt_ctr_inplace(out, iv, progress)
+        return out
+
+    def decrypt_pixels(self, img, iv, progress=None):
+        """
+        Decrypts an array from `encrypt_pixels` back into pixels.
+        """
+        return self.encrypt_pixels(img, iv, progress)
+
+    def _ghash(self):
+        """ Returns the GHASH tables for this key, built on first use and cached with the schedule. """
+        ghash = self._schedule.get('ghash')
+        if ghash is None:
+            ghash = self._schedule['ghash'] = GHash(int.from_bytes(self.encrypt_block(bytes(16)), 'big'))
+        return ghash
+
+    def _gcm_j0(self, iv):
+        if len(iv) == 12:
+            return bytes(iv) + b'\x00\x00\x00\x01'
+        return self._ghash().digest(b'', iv).to_bytes(16, 'big')
+
+    def _gctr(self, data, j0):
+        """ GCTR with the 32-bit counter starting at inc32(j0). """
+        data = np.frombuffer(data, dtype=np.uint8)
+        out = np.empty_like(data)
+        batch_bytes = CTR_BATCH_BLOCKS * 16
+        for offset in range(0, len(data), batch_bytes):
+            chunk = data[offset:offset + batch_bytes]
+            with stage('aes.keystream', n_bytes=len(chunk)):
+                words = self.encrypt_words(gcm_counter_words(j0, 1 + offset // 16, (len(chunk) + 15) // 16))
+                keystream = words.astype('>u4').view(np.uint8).reshape(-1)
+            with stage('aes.xor', n_bytes=len(chunk)):
+                np.bitwise_xor(chunk, keystream[:len(chunk)], out=out[offset:offset + len(chunk)])
+        return out.tobytes()
+
+    def _gcm_tag(self, j0, associated_data, ciphertext, tag_length):
+        with stage('aes.ghash', n_bytes=len(associated_data) + len(ciphertext)):
+            s = self._ghash().digest(associated_data, ciphertext)
+        tag = int.from_bytes(self.encrypt_block(j0), 'big') ^ s
+        return tag.to_bytes(16, 'big')[:tag_length]
+
+    def encrypt_gcm(self, plaintext, iv, associated_data=b'', tag_length=16):
+        """
+        Encrypts `plaintext` using GCM mode and returns (ciphertext, tag).
+        `associated_data` is authenticated but not encrypted. A 12 byte IV is
+        recommended and must never repeat for the same key.
+        """
+        assert len(iv) > 0
+        assert 4 <= tag_length <= 16
+
+        j0 = self._gcm_j0(iv)
+        ciphertext = self._gctr(plaintext, j0)
+        return ciphertext, self._gcm_tag(j0, associated_data, ciphertext, tag_length)
+
+    def decrypt_gcm(self, ciphertext, iv, tag, associated_data=b''):
+        """
+        Verifies `tag` over `associated_data` and `ciphertext` and only then
+        decrypts it. Raises ValueError if the tag does not match.
+        """
+        assert len(iv) > 0
+        assert 4 <= len(tag) <= 16
+
+        j0 = self._gcm_j0(iv)
+        if not hmac.compare_digest(self._gcm_tag(j0, associated_data, ciphertext, len(tag)), bytes(tag)):
+            raise ValueError('GCM authentication tag mismatch')
+        return self._gctr(ciphertext, j0)
+
+    def decrypt_range(self, ciphertext, iv, offset, length):
+        """
+        Decrypts `length` bytes starting at byte `offset` of a CTR
+        `ciphertext` (any buffer, e.g. a mmap of the whole file) without
+        touching the bytes before it.
+        """
+        assert 0 <= offset and 0 <= length
+        view = memoryview(ciphertext).cast('B')[offset:offset + length]
+        stream = self.ctr_stream(iv)
+        stream.seek(offset)
+        return stream.update(view)
+
+    def ctr_stream(self, iv):
+        """
+        Returns an incremental `CTRStream` encryptor/decryptor for `iv`.
+        """
+        return CTRStream(self, iv)
+
+    def encrypt_file(self, src, dst, iv, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Encrypts the file at path `src` into `dst` using CTR mode, reading
+        `chunk_size` bytes at a time so memory use does not depend on the
+        file size. Returns the number of bytes processed.
+        """
+        stream = self.ctr_stream(iv)
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        total = 0
+        with open(src, 'rb') as input_file, open(dst, 'wb') as output_file:
+            while True:
+                n = input_file.readinto(buffer)
+                if not n:
+                    break
+                output_file.write(stream.update(view[:n]))
+                total += n
+            output_file.write(stream.finalize())
+        return total
+
+    def decrypt_file(self, src, dst, iv, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Decrypts the file at path `src` into `dst` using CTR mode.
+        """
+        return self.encrypt_file(src, dst, iv, chunk_size)
+
+    def encrypt_ctr_reference(self, plaintext, iv):
+        """
+        Encrypts `plaintext` using CTR mode with the given nounce/IV, one
+        counter block at a time. Kept as the reference for `encrypt_ctr`.
         """
         assert len(iv) == 16
 
@@ -272,9 +1118,10 @@ class AES:
 
         return b''.join(blocks)
 
-    def decrypt_ctr(self, ciphertext, iv):
+    def decrypt_ctr_reference(self, ciphertext, iv):
         """
-        Decrypts `ciphertext` using CTR mode with the given nounce/IV.
+        Decrypts `ciphertext` using CTR mode with the given nounce/IV, one
+        counter block at a time. Kept as the reference for `decrypt_ctr`.
         """
         assert len(iv) == 16
 
@@ -287,3 +1134,63 @@ class AES:
             nonce = inc_bytes(nonce)
 
         return b''.join(blocks)
+
+
+class CTRStream:
+    """
+    Incremental CTR mode encryptor. Chunks passed to `update` may have any
+    length; the byte position is carried across calls so the output is the
+    same as one `encrypt_ctr` call over the concatenated input.
+    """
+
+    def __init__(self, cipher, iv):
+        assert len(iv) == 16
+        self._cipher = cipher
+        self._iv = bytes(iv)
+        self._position = 0
+        self._finalized = False
+
+    @property
+    def position(self):
+        """ Number of bytes processed so far.  """
+        return self._position
+
+    def seek(self, position):
+        """
+        Moves the stream to byte `position`. CTR keystream at any position
+        depends only on `iv + position // 16`, so this costs nothing.
+        """
+        assert position >= 0
+        self._position = position
+
+    def update(self, chunk):
+        """
+        Encrypts (or decrypts) the next `chunk` and returns the result.
+        """
+        assert not self._finalized, 'update() called after finalize()'
+        data = np.frombuffer(chunk, dtype=np.uint8)
+        if not len(data):
+            return b''
+
+        out = np.empty_like(data)
+        batch_bytes = CTR_BATCH_BLOCKS * 16
+        for offset in range(0, len(data), batch_bytes):
+            part = data[offset:offset + batch_bytes]
+            position = self._position + offset
+            # Skip into the first counter block when the position is not block aligned.
+            skip = position % 16
+            n_blocks = (skip + len(part) + 15) // 16
+            keystream = self._cipher.ctr_keystream(self._iv, position // 16, n_blocks)
+            with stage('aes.xor', n_bytes=len(part)):
+                np.bitwise_xor(part, keystream[skip:skip + len(part)], out=out[offset:offset + len(part)])
+
+        self._position += len(data)
+        return out.tobytes()
+
+    def finalize(self):
+        """
+        Ends the stream. CTR mode keeps no buffered input, so this returns
+        an empty byte string.
+        """
+        self._finalized = True
+        return b''
@@ -0,0 +1,313 @@
+"""
+Headless batch encryption of image directories.
+
+    python batch_encrypt.py keygen --mode aes -k aes.key
+    python batch_encrypt.py encrypt --mode aes -k aes.key -i photos/ -o encrypted/ --workers 8
+    python batch_encrypt.py decrypt --mode aes -k aes.key -i encrypted/ -o decrypted/
+
+Outputs are `container` files (`.aeic`) whose header records the algorithm,
+key id, IV and shape. AES files are encrypted whole in CTR mode with a fresh
+IV per file. RSA encrypts decoded pixels with `encrypt_rsa`; decryption
+writes `.png`. RSA ciphertexts are stored as unsigned integers of at most
+64 bits, so RSA keys are limited to `RSA_MAX_PRIME_BITS` bit primes (the
+keygen default). A `summary.json` with per-file results is written next to the
+outputs; with --stats it also holds per-stage timings from `instrument`.
+With --preview, `encrypt` also writes a `.preview.png` of each container's
+ciphertext, sampled from the memory-mapped payload.
+Neither Qt nor OpenCV is imported unless an RSA job needs to decode
+or encode an image.
+"""
+import argparse
+import fnmatch
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from aes import AES, STREAM_CHUNK_SIZE
+import container
+import instrument
+from instrument import stage
+from encrypt_rsa import cipher_dtype, gen_keys, RSAPrivateKey
+
+logger = logging.getLogger('batch')
+
+# Largest RSA prime size whose modulus, and so every ciphertext value, fits in uint64.
+RSA_MAX_PRIME_BITS = 32
+
+DEFAULT_PATTERNS = {
+    ('encrypt', 'aes'): '*',
+    ('encrypt', 'rsa'): '*.jp*g *.png *.bmp *.tif *.tiff',
+    ('decrypt', 'aes'): '*.aeic',
+    ('decrypt', 'rsa'): '*.aeic',
+}
+
+
+def load_key(mode, path):
+    """ Reads an AES key (raw bytes) or an RSA key (JSON) written by `keygen`. """
+    if mode == 'aes':
+        with open(path, 'rb') as key_file:
+            return key_file.read()
+    with open(path) as key_file:
+        return json.load(key_file)
+
+
+def check_rsa_modulus(n_modulus):
+    """ Raises ValueError for moduli whose ciphertexts do not fit in a container. """
+    if cipher_dtype(n_modulus).hasobject:
+        raise ValueError(f'RSA modulus of {n_modulus.bit_length()} bits is wider than 64 bits; '
+                         f'generate a key with --bits {RSA_MAX_PRIME_BITS} or less')
+
+
+def write_key(mode, path, bits):
+    if mode == 'aes':
+        with open(path, 'wb') as key_file:
+            key_file.write(os.urandom(bits // 8))
+        return
+    if bits > RSA_MAX_PRIME_BITS:
+        raise ValueError(f'RSA primes are limited to {RSA_MAX_PRIME_BITS} bits so ciphertexts fit in uint64')
+    p_prime, q_prime, e, n_modulus, d_private = gen_keys(bits)
+    with open(path, 'w') as key_file:
+        json.dump({'p': p_prime, 'q': q_prime, 'e': e, 'n': n_modulus, 'd': d_private}, key_file)
+
+
+def find_inputs(source, patterns):
+    """
+    Returns (path, relative path) pairs for `source`, either a directory that
+    is walked for files matching any of `patterns`, or a manifest file with
+    one path per line (blank lines and '#' comments ignored). Manifest
+    entries are made relative to the deepest directory containing them all,
+    so equal file names in different directories stay apart.
+    """
+    if os.path.isdir(source):
+        inputs = []
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if any(fnmatch.fnmatch(name.lower(), pattern) for pattern in patterns):
+                    path = os.path.join(root, name)
+                    inputs.append((path, os.path.relpath(path, source)))
+        return sorted(inputs)
+
+    base = os.path.dirname(os.path.abspath(source))
+    paths = []
+    with open(source) as manifest:
+        for line in manifest:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                paths.append(os.path.normpath(os.path.join(base, line)))
+    if not paths:
+        return []
+    common = os.path.commonpath([os.path.dirname(path) for path in paths])
+    return [(path, os.path.relpath(path, common)) for path in paths]
+
+
+def output_path(output_dir, relative, command, mode):
+    if command == 'encrypt':
+        return os.path.join(output_dir, relative + '.aeic')
+    stem, ext = os.path.splitext(relative)
+    if mode == 'aes':
+        return os.path.join(output_dir, stem if ext == '.aeic' else relative + '.dec')
+    return os.path.join(output_dir, (stem if ext == '.aeic' else relative) + '.png')
+
+
+def _ctr_copy(stream, input_file, output_file, chunk_size=STREAM_CHUNK_SIZE):
+    while True:
+        chunk = input_file.read(chunk_size)
+        if not chunk:
+            break
+        output_file.write(stream.update(chunk))
+
+
+def aes_encrypt_file(key, src, dst):
+    size = os.path.getsize(src)
+    header = container.Header('aes-ctr', np.uint8, (size,), container.key_id(key), os.urandom(16), bytes(16), size)
+    with open(src, 'rb') as input_file, open(dst, 'wb') as output_file:
+        output_file.write(container.pack_header(header))
+        _ctr_copy(AES(key).ctr_stream(header.iv), input_file, output_file)
+    return size
+
+
+def aes_decrypt_file(key, src, dst):
+    with open(src, 'rb') as input_file, open(dst, 'wb') as output_file:
+        header = container.read_header(input_file.read(container.HEADER.size))
+        if header.algorithm != 'aes-ctr' or header.key_id != container.key_id(key):
+            raise ValueError(f'{src} is not AES-CTR encrypted with this key')
+        _ctr_copy(AES(key).ctr_stream(header.iv), input_file, output_file)
+    return header.payload_length
+
+
+def rsa_encrypt_file(key, src, dst):
+    import cv2
+    check_rsa_modulus(key['n'])
+    with stage('codec.decode'):
+        img = cv2.imread(src)
+    if img is None:
+        raise ValueError(f'cannot decode image {src}')
+    with open(dst, 'wb') as output_file:
+        output_file.write(container.encrypt_rsa_image(img, key['e'], key['n']))
+    return os.path.getsize(src)
+
+
+def rsa_decrypt_file(key, src, dst):
+    import cv2
+    private_key = RSAPrivateKey(key['p'], key['q'], key['e'], key['d'])
+    with open(src, 'rb') as input_file:
+        img = container.decrypt_array(input_file.read(), private_key)
+    with stage('codec.encode'):
+        written = cv2.imwrite(dst, img)
+    if not written:
+        raise ValueError(f'cannot encode image {dst}')
+    return os.path.getsize(src)
+
+
+JOBS = {
+    ('encrypt', 'aes'): aes_encrypt_file,
+    ('decrypt', 'aes'): aes_decrypt_file,
+    ('encrypt', 'rsa'): rsa_encrypt_file,
+    ('decrypt', 'rsa'): rsa_decrypt_file,
+}
+
+
+def write_preview(path, resize=(400, 400)):
+    """ Writes a PNG visualizing the payload of the container at `path` and returns its path. """
+    from preview import buffer_preview
+    _, payload = container.map_file(path)
+    png = buffer_preview(payload, resize)
+    payload.release()
+    preview_path = os.path.splitext(path)[0] + '.preview.png'
+    with open(preview_path, 'wb') as preview_file:
+        preview_file.write(png)
+    return preview_path
+
+
+def process_file(task):
+    """ Runs one file job in a worker process and returns its result record. """
+    command, mode, key, src, dst, collect_stats, preview = task
+    if collect_stats:
+        instrument.enable()
+        instrument.stats.reset()
+    start = time.perf_counter()
+    try:
+        os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+        n_bytes = JOBS[command, mode](key, src, dst)
+        result = {'input': src, 'output': dst, 'bytes': n_bytes}
+        if preview and command == 'encrypt':
+            result['preview'] = write_preview(dst)
+        result['seconds'] = time.perf_counter() - start
+    except Exception as exc:
+        result = {'input': src, 'output': dst, 'error': f'{type(exc).__name__}: {exc}',
+                  'seconds': time.perf_counter() - start}
+    if collect_stats:
+        result['stats'] = instrument.stats.snapshot()
+    return result
+
+
+def run_batch(command, mode, key, inputs, output_dir, workers=None, collect_stats=False, preview=False):
+    """ Processes (path, relative path) inputs across a process pool and returns the summary. """
+    tasks = []
+    duplicates = []
+    seen = set()
+    for src, relative in inputs:
+        dst = output_path(output_dir, relative, command, mode)
+        if dst in seen:
+            # A second write to the same output would silently replace the first (or race with it).
+            duplicates.append({'input': src, 'output': dst, 'error': 'duplicate output path', 'seconds': 0.0})
+            continue
+        seen.add(dst)
+        tasks.append((command, mode, key, src, dst, collect_stats, preview))
+    start = time.perf_counter()
+    if workers == 1:
+        results = [process_file(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(process_file, tasks))
+    results += duplicates
+    elapsed = time.perf_counter() - start
+
+    failures = [result for result in results if 'error' in result]
+    total_bytes = sum(result.get('bytes', 0) for result in results)
+    summary_stats = instrument.Stats()
+    for result in results:
+        summary_stats.merge(result.pop('stats', {}))
+    return {
+        'command': command,
+        'mode': mode,
+        'files': len(results),
+        'failures': len(failures),
+        'bytes': total_bytes,
+        'seconds': elapsed,
+        'files_per_second': len(results) / elapsed if elapsed else 0.0,
+        'megabytes_per_second': total_bytes / elapsed / 1e6 if elapsed else 0.0,
+        'stats': summary_stats.snapshot() if collect_stats else None,
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Batch image encryption with AES-CTR or RSA.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    keygen = subparsers.add_parser('keygen', help='write a new key file')
+    keygen.add_argument('--mode', choices=('aes', 'rsa'), default='aes')
+    keygen.add_argument('-k', '--key', required=True)
+    keygen.add_argument('--bits', type=int,
+                        help=f'AES key bits (128/192/256) or RSA prime bits (at most {RSA_MAX_PRIME_BITS})')
+
+    for command in ('encrypt', 'decrypt'):
+        sub = subparsers.add_parser(command, help=f'{command} a directory or manifest of files')
+        sub.add_argument('--mode', choices=('aes', 'rsa'), default='aes')
+        sub.add_argument('-k', '--key', required=True)
+        sub.add_argument('-i', '--input', required=True, help='input directory or manifest file')
+        sub.add_argument('-o', '--output', required=True, help='output directory')
+        sub.add_argument('--pattern', help='space separated filename globs for directory input')
+        sub.add_argument('--workers', type=int, default=None)
+        sub.add_argument('--summary', help='summary JSON path (default: <output>/summary.json)')
+        sub.add_argument('--stats', action='store_true', help='record and report per-stage timings')
+        if command == 'encrypt':
+            sub.add_argument('--preview', action='store_true', help='write a .preview.png of each ciphertext')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'keygen':
+        try:
+            write_key(args.mode, args.key, args.bits or (128 if args.mode == 'aes' else RSA_MAX_PRIME_BITS))
+        except ValueError as exc:
+            parser.error(str(exc))
+        logger.info(f'Wrote {args.mode.upper()} key to {args.key}')
+        return 0
+
+    key = load_key(args.mode, args.key)
+    if args.mode == 'rsa':
+        try:
+            check_rsa_modulus(key['n'])
+        except ValueError as exc:
+            parser.error(str(exc))
+    patterns = (args.pattern or DEFAULT_PATTERNS[args.command, args.mode]).split()
+    inputs = find_inputs(args.input, patterns)
+    summary = run_batch(args.command, args.mode, key, inputs, args.output, args.workers,
+                        args.stats or instrument.enabled, getattr(args, 'preview', False))
+
+    summary_path = args.summary or os.path.join(args.output, 'summary.json')
+    os.makedirs(os.path.dirname(summary_path) or '.', exist_ok=True)
+    with open(summary_path, 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+
+    for result in summary['results']:
+        if 'error' in result:
+            logger.error(f'{result["input"]}: {result["error"]}')
+    logger.info(f'{summary["files"]} files, {summary["failures"]} failures, {summary["bytes"]} bytes '
+                f'in {summary["seconds"]:.2f}s ({summary["files_per_second"]:.1f} files/s, '
+                f'{summary["megabytes_per_second"]:.1f} MB/s)')
+    if summary['stats']:
+        for line in instrument.snapshot_lines(summary['stats']):
+            logger.info(line)
+    return 1 if summary['failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,36 @@
+"""
+Times `encrypt_rsa.gen_keys` per prime bit length.
+
+    python -m benchmarks.keygen [--bits 7 64 256 512 1024] [--repeat 5]
+"""
+import argparse
+import statistics
+import time
+
+from encrypt_rsa import gen_keys, MILLER_RABIN_ROUNDS
+
+
+def bench_gen_keys(bits, repeat, rounds=MILLER_RABIN_ROUNDS):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        gen_keys(bits, rounds)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--bits', type=int, nargs='+', default=[7, 64, 256, 512, 1024])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--rounds', type=int, default=MILLER_RABIN_ROUNDS)
+    args = parser.parse_args()
+
+    print(f'{"bits":>6} {"median s":>10} {"min s":>10} {"max s":>10}')
+    for bits in args.bits:
+        timings = bench_gen_keys(bits, args.repeat, args.rounds)
+        print(f'{bits:>6} {statistics.median(timings):>10.4f} {min(timings):>10.4f} {max(timings):>10.4f}')
+
+
+if __name__ == '__main__':
+    main()
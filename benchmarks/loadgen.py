@@ -0,0 +1,148 @@
+"""
+Load generator for the `service` encryption server.
+
+    python -m benchmarks.loadgen [--connections 32] [--requests 2000] [--size 4096] [--path /aes/encrypt]
+    python -m benchmarks.loadgen --port 8080                     # against a running service
+    python -m benchmarks.loadgen --unix /tmp/image-encryption.sock
+
+Without --port or --unix a service is started in this process on a free
+port. Each connection sends requests back to back over keep-alive; the
+report gives requests/s, MB/s and p50/p90/p99 latency.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+from encrypt_rsa import gen_keys
+from service import EncryptionService, MAX_IN_FLIGHT
+
+
+def request_headers(path, key_size):
+    if path.startswith('/aes/'):
+        return {'X-Key': os.urandom(key_size).hex(), 'X-IV': os.urandom(16).hex()}
+    p_prime, q_prime, e, n_modulus, d_private = gen_keys(7)
+    if path == '/rsa/encrypt':
+        return {'X-RSA-E': e, 'X-RSA-N': n_modulus}
+    return {'X-RSA-P': p_prime, 'X-RSA-Q': q_prime, 'X-RSA-E': e, 'X-RSA-D': d_private}
+
+
+async def read_response(reader):
+    """ Reads one response and returns (status, body length). """
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+    status = int(head[0].split()[1])
+    headers = {name.lower(): value.strip() for name, _, value in (line.partition(':') for line in head[1:] if line)}
+    if 'content-length' in headers:
+        return status, len(await reader.readexactly(int(headers['content-length'])))
+    received = 0
+    while True:
+        size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+        await reader.readexactly(size + 2)
+        received += size
+        if not size:
+            return status, received
+
+
+async def client(connect, path, headers, body, remaining, latencies, errors):
+    reader, writer = await connect()
+    head = ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+    request = (f'POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n{head}\r\n').encode() + body
+    try:
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status, _ = await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def run(args):
+    service = None
+    if args.port is None and args.unix is None:
+        service = EncryptionService(args.max_in_flight, args.workers)
+        server = await service.start(port=0)
+        host, port = '127.0.0.1', server.sockets[0].getsockname()[1]
+    else:
+        host, port = args.host, args.port
+
+    if args.unix:
+        def connect():
+            return asyncio.open_unix_connection(args.unix)
+    else:
+        def connect():
+            return asyncio.open_connection(host, port)
+
+    headers = request_headers(args.path, args.key_size)
+    body = os.urandom(args.size)
+    if args.path == '/rsa/decrypt':
+        # Any uint16 values below the modulus decrypt; 7 bit primes keep n below 2**14.
+        body = bytes(len(body) - len(body) % 2)
+    latencies, errors = [], []
+    remaining = [args.requests]
+    start = time.perf_counter()
+    await asyncio.gather(*(client(connect, args.path, headers, body, remaining, latencies, errors)
+                           for _ in range(args.connections)))
+    elapsed = time.perf_counter() - start
+    if service is not None:
+        server.close()
+        await server.wait_closed()
+        service.close()
+
+    latencies.sort()
+    return {
+        'path': args.path,
+        'connections': args.connections,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'size': len(body),
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed,
+        'mb_per_s': len(latencies) * len(body) / elapsed / 1e6,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p90_ms': percentile(latencies, 0.90) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': statistics.fmean(latencies) * 1000,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--unix')
+    parser.add_argument('--path', default='/aes/encrypt',
+                        choices=('/aes/encrypt', '/aes/decrypt', '/rsa/encrypt', '/rsa/decrypt'))
+    parser.add_argument('--connections', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=4096, help='request body bytes')
+    parser.add_argument('--key-size', type=int, default=16, help='AES key bytes')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT, help='for the in-process service')
+    parser.add_argument('--workers', type=int, help='executor threads of the in-process service')
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args))
+    print(f'{report["requests"]} requests of {report["size"]} bytes on {report["connections"]} connections '
+          f'in {report["seconds"]:.2f}s: {report["requests_per_second"]:.0f} req/s, {report["mb_per_s"]:.1f} MB/s, '
+          f'p50 {report["p50_ms"]:.2f} ms, p90 {report["p90_ms"]:.2f} ms, p99 {report["p99_ms"]:.2f} ms, '
+          f'{report["errors"]} errors')
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,311 @@
+"""
+Benchmarks the AES, RSA and preview engines on synthetic images and the
+bundled rgb_bird.jpeg, and cross-checks every fast path against its
+reference implementation.
+
+    python -m benchmarks.suite [--sizes 256 1024 4096] [--json out.json] [--compare old.json]
+
+Each record reports seconds per call, MB/s, pixels/s, the process peak RSS
+after the case and the peak memory traced (Python and NumPy allocations)
+during one call. Records are keyed by `name`, so two JSON runs can be compared.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from aes import AES, GHash, gf128_mul
+from encrypt_rsa import (gen_keys, image_encryption, image_decryption, image_decryption_crt,
+                         image_encryption_reference, image_decryption_reference, RSAPrivateKey)
+from preview import array_preview, buffer_preview, clear_preview_cache, resize_image
+
+BIRD_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'rgb_bird.jpeg')
+
+# Largest image side the per-block reference paths are run on.
+REFERENCE_MAX_SIDE = 256
+
+_GCM_KEY = 'feffe9928665731c6d6a8f9467308308'
+_GCM_PLAINTEXT = ('d9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d8a318a72'
+                  '1c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657ba637b39')
+_GCM_AAD = 'feedfacedeadbeeffeedfacedeadbeefabaddad2'
+
+# GCM known answers from the GCM specification test cases (as used for SP 800-38D):
+# (name, key, iv, plaintext, associated data, ciphertext, tag), all hex.
+GCM_VECTORS = [
+    ('empty', '00' * 16, '00' * 12, '', '', '', '58e2fccefa7e3061367f1d57a4e7455a'),
+    ('one-block', '00' * 16, '00' * 12, '00' * 16, '', '0388dace60b6a392f328c2b971b2fe78',
+     'ab6e47d42cec13bdf53a67b21257bddf'),
+    ('iv96-aad-partial', _GCM_KEY, 'cafebabefacedbaddecaf888', _GCM_PLAINTEXT, _GCM_AAD,
+     '42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e2329aca12e'
+     '21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac973d58e091', '5bc94fbc3221a5db94fae95ae7121a47'),
+    ('iv64', _GCM_KEY, 'cafebabefacedbad', _GCM_PLAINTEXT, _GCM_AAD,
+     '61353b4c2806934a777ff51fa22a4755699b2a714fcdc6f83766e5f97b6c7423'
+     '73806900e49f24b22b097544d4896b424989b5e1ebac0f07c23f4598', '3612d2e79e3b0785561be14aaca2fccb'),
+    ('iv480', _GCM_KEY, '9313225df88406e555909c5aff5269aa6a7a9538534f7da1e4c303d2a318a728'
+     'c3c0c95156809539fcf0e2429a6b525416aedbf5a0de6a57a637b39b', _GCM_PLAINTEXT, _GCM_AAD,
+     '8ce24998625615b603a033aca13fb894be9112a5c3a211a8ba262a3cca7e2ca7'
+     '01e4a9a4fba43c90ccdcb281d48c7c6fd62875d2aca417034c34aee5', '619cc5aefffe0bfa462af43c1699d050'),
+    ('aes256-iv96-aad-partial', _GCM_KEY * 2, 'cafebabefacedbaddecaf888', _GCM_PLAINTEXT, _GCM_AAD,
+     '522dc1f099567d07f47f37a32a84427d643a8cdcbfe5c0c97598a2bd2555d1aa'
+     '8cb08e48590dbb3da7b08b1056828838c5f61e6393ba7a0abcc9f662', '76fc6ece0f4e1768cddf8853bb2d551b'),
+]
+
+
+def synthetic_image(side, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (side, side, 3), dtype=np.uint8)
+
+
+def load_images(sizes):
+    images = {f'{side}x{side}': synthetic_image(side) for side in sizes}
+    images['rgb_bird'] = np.asarray(Image.open(BIRD_PATH).convert('RGB'))
+    return images
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def traced_peak(fn):
+    """ Returns the peak bytes allocated and still live at any point during one call of fn. """
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def measure(name, fn, n_bytes=0, n_pixels=0, repeat=3, trace=True):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    seconds = statistics.median(timings)
+    record = {
+        'name': name,
+        'seconds': seconds,
+        'min_seconds': min(timings),
+        'bytes': n_bytes,
+        'pixels': n_pixels,
+        'mb_per_s': n_bytes / seconds / 1e6 if n_bytes and seconds else None,
+        'pixels_per_s': n_pixels / seconds if n_pixels and seconds else None,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+    if trace:
+        record['traced_peak_bytes'] = traced_peak(fn)
+    return record
+
+
+def bench_aes(images, key_sizes, repeat, workers):
+    records = []
+    iv = bytes(16)
+    for key_size in key_sizes:
+        cipher = AES(bytes(range(key_size)))
+        block = bytes(16)
+        records.append(measure(f'aes{key_size * 8}/block/ttable', lambda: [cipher.encrypt_block(block) for _ in range(1000)],
+                               n_bytes=16000, repeat=repeat))
+        records.append(measure(f'aes{key_size * 8}/block/reference',
+                               lambda: [cipher.encrypt_block_reference(block) for _ in range(1000)],
+                               n_bytes=16000, repeat=repeat))
+        for label, img in images.items():
+            data = img.tobytes()
+            records.append(measure(f'aes{key_size * 8}/ctr/batched/{label}', lambda: cipher.encrypt_ctr(data, iv),
+                                   n_bytes=len(data), n_pixels=img.shape[0] * img.shape[1], repeat=repeat))
+            records.append(measure(f'aes{key_size * 8}/gcm/{label}', lambda: cipher.encrypt_gcm(data, iv[:12]),
+                                   n_bytes=len(data), n_pixels=img.shape[0] * img.shape[1], repeat=repeat))
+            cbc = cipher.encrypt_cbc(data, iv) if max(img.shape[:2]) <= REFERENCE_MAX_SIDE else None
+            if cbc is not None:
+                records.append(measure(f'aes{key_size * 8}/cbc/decrypt/{label}', lambda: cipher.decrypt_cbc(cbc, iv),
+                                       n_bytes=len(data), n_pixels=img.shape[0] * img.shape[1], repeat=repeat))
+            records.append(measure(f'aes{key_size * 8}/ctr/parallel/{label}',
+                                   lambda: cipher.encrypt_ctr_parallel(data, iv, workers=workers),
+                                   n_bytes=len(data), n_pixels=img.shape[0] * img.shape[1], repeat=repeat,
+                                   trace=False))
+            if max(img.shape[:2]) <= REFERENCE_MAX_SIDE:
+                records.append(measure(f'aes{key_size * 8}/ctr/reference/{label}',
+                                       lambda: cipher.encrypt_ctr_reference(data, iv),
+                                       n_bytes=len(data), n_pixels=img.shape[0] * img.shape[1], repeat=1,
+                                       trace=False))
+    return records
+
+
+def bench_rsa(images, bits, repeat):
+    records = []
+    p_prime, q_prime, e, n_modulus, d_private = gen_keys(bits)
+    private_key = RSAPrivateKey(p_prime, q_prime, e, d_private)
+    for label, img in images.items():
+        row, col = img.shape[:2]
+        ciphertext = image_encryption(img, e, n_modulus, row, col)
+        records.append(measure(f'rsa{bits}/encrypt/vectorized/{label}',
+                               lambda: image_encryption(img, e, n_modulus, row, col),
+                               n_bytes=img.nbytes, n_pixels=row * col, repeat=repeat))
+        records.append(measure(f'rsa{bits}/decrypt/vectorized/{label}',
+                               lambda: image_decryption(ciphertext, d_private, n_modulus, row, col),
+                               n_bytes=img.nbytes, n_pixels=row * col, repeat=repeat))
+        records.append(measure(f'rsa{bits}/decrypt/crt/{label}',
+                               lambda: image_decryption_crt(ciphertext, private_key, row, col),
+                               n_bytes=img.nbytes, n_pixels=row * col, repeat=repeat))
+        if max(row, col) <= REFERENCE_MAX_SIDE:
+            records.append(measure(f'rsa{bits}/encrypt/reference/{label}',
+                                   lambda: image_encryption_reference(img, e, n_modulus, row, col),
+                                   n_bytes=img.nbytes, n_pixels=row * col, repeat=1, trace=False))
+    return records
+
+
+def bench_gen_keys(bit_lengths, repeat):
+    return [measure(f'gen_keys/{bits}', lambda: gen_keys(bits), repeat=repeat, trace=False)
+            for bits in bit_lengths]
+
+
+def bench_preview(images, repeat):
+    records = []
+    for label, img in images.items():
+        bio = io.BytesIO()
+        Image.fromarray(img).save(bio, format='PNG')
+        png = bio.getvalue()
+        # Clear the preview cache so every call decodes.
+        records.append(measure(f'preview/resize_image/{label}',
+                               lambda: (clear_preview_cache(), resize_image(png, resize=(400, 400))),
+                               n_bytes=len(png), n_pixels=img.shape[0] * img.shape[1], repeat=repeat))
+        records.append(measure(f'preview/array_preview/{label}', lambda: array_preview(img, resize=(400, 400)),
+                               n_bytes=img.nbytes, n_pixels=img.shape[0] * img.shape[1], repeat=repeat))
+        data = img.tobytes()
+        records.append(measure(f'preview/buffer_preview/{label}', lambda: buffer_preview(data, resize=(400, 400)),
+                               n_bytes=len(data), repeat=repeat))
+    return records
+
+
+def ghash_reference(h, associated_data, ciphertext):
+    """ GHASH one block at a time with the bitwise field multiplication. """
+    y = 0
+    for part in (associated_data, ciphertext):
+        part = part + bytes(-len(part) % 16)
+        for offset in range(0, len(part), 16):
+            y = gf128_mul(y ^ int.from_bytes(part[offset:offset + 16], 'big'), h)
+    lengths = (len(associated_data) * 8).to_bytes(8, 'big') + (len(ciphertext) * 8).to_bytes(8, 'big')
+    return gf128_mul(y ^ int.from_bytes(lengths, 'big'), h)
+
+
+def gcm_known_answers():
+    """ Checks `encrypt_gcm`/`decrypt_gcm` against `GCM_VECTORS`, including tag rejection. """
+    checks = {}
+    for name, key, iv, plaintext, associated_data, ciphertext, tag in GCM_VECTORS:
+        key, iv, plaintext, associated_data, ciphertext, tag = (
+            bytes.fromhex(v) for v in (key, iv, plaintext, associated_data, ciphertext, tag))
+        cipher = AES(key)
+        checks[f'gcm/kat/{name}'] = (cipher.encrypt_gcm(plaintext, iv, associated_data) == (ciphertext, tag) and
+                                     cipher.decrypt_gcm(ciphertext, iv, tag, associated_data) == plaintext)
+        tampered = bytes([tag[0] ^ 1]) + tag[1:]
+        try:
+            cipher.decrypt_gcm(ciphertext, iv, tampered, associated_data)
+            checks[f'gcm/kat/{name}/tampered'] = False
+        except ValueError:
+            checks[f'gcm/kat/{name}/tampered'] = True
+    return checks
+
+
+def cross_check(key_sizes, bits):
+    """ Compares every fast path with its reference on small inputs. """
+    checks = {}
+    data = os.urandom(4099)
+    iv = b'\xff' * 8 + os.urandom(8)
+    for key_size in key_sizes:
+        cipher = AES(os.urandom(key_size))
+        block = os.urandom(16)
+        encrypted = cipher.encrypt_block_reference(block)
+        checks[f'aes{key_size * 8}/block'] = (cipher.encrypt_block(block) == encrypted and
+                                              cipher.decrypt_block(encrypted) == block)
+        expected = cipher.encrypt_ctr_reference(data, iv)
+        checks[f'aes{key_size * 8}/ctr/batched'] = cipher.encrypt_ctr(data, iv) == expected
+        checks[f'aes{key_size * 8}/ctr/parallel'] = cipher.encrypt_ctr_parallel(
+            data, iv, workers=2, chunk_size=1024) == expected
+        ciphertext = cipher.encrypt_cbc(data, iv)
+        checks[f'aes{key_size * 8}/cbc'] = (cipher.decrypt_cbc(ciphertext, iv) == data ==
+                                            cipher.decrypt_cbc_reference(ciphertext, iv))
+        ciphertext, tag = cipher.encrypt_gcm(data, iv[:12], b'header')
+        checks[f'aes{key_size * 8}/gcm'] = (ciphertext == cipher.encrypt_ctr_reference(data, iv[:12] + b'\x00\x00\x00\x02') and
+                                            cipher.decrypt_gcm(ciphertext, iv[:12], tag, b'header') == data)
+        # Long enough to exercise the folded multi-block GHASH path.
+        h = int.from_bytes(cipher.encrypt_block_reference(bytes(16)), 'big')
+        checks[f'aes{key_size * 8}/ghash'] = GHash(h).digest(b'header', data) == ghash_reference(h, b'header', data)
+    checks.update(gcm_known_answers())
+
+    img = synthetic_image(32, seed=1)
+    p_prime, q_prime, e, n_modulus, d_private = gen_keys(bits)
+    ciphertext = image_encryption_reference(img, e, n_modulus, 32, 32)
+    plaintext = image_decryption_reference(ciphertext, d_private, n_modulus, 32, 32)
+    checks[f'rsa{bits}/encrypt'] = bool((image_encryption(img, e, n_modulus, 32, 32) == ciphertext).all())
+    checks[f'rsa{bits}/decrypt'] = bool((image_decryption(ciphertext, d_private, n_modulus, 32, 32) == plaintext).all())
+    private_key = RSAPrivateKey(p_prime, q_prime, e, d_private)
+    checks[f'rsa{bits}/decrypt/crt'] = bool((image_decryption_crt(ciphertext, private_key, 32, 32) == plaintext).all())
+    return checks
+
+
+def compare(records, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = {record['name']: record for record in json.load(baseline_file)['records']}
+    print(f'\n{"name":<48} {"old s":>10} {"new s":>10} {"speedup":>8}')
+    for record in records:
+        old = baseline.get(record['name'])
+        if old and record['seconds']:
+            print(f'{record["name"]:<48} {old["seconds"]:>10.4f} {record["seconds"]:>10.4f} '
+                  f'{old["seconds"] / record["seconds"]:>7.2f}x')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 1024, 4096])
+    parser.add_argument('--key-sizes', type=int, nargs='+', default=[16, 24, 32], help='AES key bytes')
+    parser.add_argument('--rsa-bits', type=int, default=7, help='RSA prime bits, as used by the GUI')
+    parser.add_argument('--keygen-bits', type=int, nargs='+', default=[7, 256, 512, 1024])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='print speedups against an earlier --json file')
+    args = parser.parse_args(argv)
+
+    checks = cross_check(args.key_sizes, args.rsa_bits)
+    images = load_images(args.sizes)
+    records = []
+    records += bench_aes(images, args.key_sizes, args.repeat, args.workers)
+    records += bench_rsa(images, args.rsa_bits, args.repeat)
+    records += bench_gen_keys(args.keygen_bits, args.repeat)
+    records += bench_preview(images, args.repeat)
+
+    print(f'{"name":<48} {"s/call":>10} {"MB/s":>10} {"Mpx/s":>10} {"peak MB":>8} {"RSS MB":>8}')
+    for record in records:
+        mb_per_s = f'{record["mb_per_s"]:.1f}' if record['mb_per_s'] else '-'
+        mpx_per_s = f'{record["pixels_per_s"] / 1e6:.2f}' if record['pixels_per_s'] else '-'
+        traced = f'{record["traced_peak_bytes"] / 1e6:.1f}' if 'traced_peak_bytes' in record else '-'
+        print(f'{record["name"]:<48} {record["seconds"]:>10.4f} {mb_per_s:>10} {mpx_per_s:>10} '
+              f'{traced:>8} {record["peak_rss_kb"] / 1024:>8.0f}')
+    print('\ncorrectness: ' + ', '.join(f'{name}={"ok" if ok else "FAIL"}' for name, ok in checks.items()))
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({
+                'python': sys.version.split()[0],
+                'numpy': np.__version__,
+                'machine': platform.machine(),
+                'cpus': os.cpu_count(),
+                'checks': checks,
+                'records': records,
+            }, json_file, indent=2)
+    if args.compare:
+        compare(records, args.compare)
+    return 0 if all(checks.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""
+Compact binary container for encrypted images.
+
+A fixed-size header (`HEADER.size` bytes, little endian) is followed by the
+ciphertext:
+
+    magic 'AEIC', version, algorithm, ndim, dtype (numpy str, e.g. '|u1'),
+    key id (16 bytes), IV (16 bytes), GCM tag (16 bytes, zero otherwise),
+    shape (4 x uint64), payload length (uint64)
+
+The shape and dtype are those of the plaintext array, or of the ciphertext
+array for RSA, whose values do not fit in the plaintext dtype. One header
+read tells a tool everything about a file, and `split` returns the payload
+as a zero-copy memoryview.
+"""
+import hashlib
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from aes import AES
+
+MAGIC = b'AEIC'
+VERSION = 1
+HEADER = struct.Struct('<4sBBBx4s16s16s16s4QQ')
+MAX_DIMS = 4
+
+ALGORITHMS = {'aes-ctr': 1, 'aes-gcm': 2, 'rsa': 3}
+ALGORITHM_NAMES = {code: name for name, code in ALGORITHMS.items()}
+
+Header = namedtuple('Header', 'algorithm dtype shape key_id iv tag payload_length')
+
+
+def key_id(key):
+    """ Returns a 16 byte identifier for an AES key that does not reveal it. """
+    return hashlib.sha256(b'image-encryption key id\x00' + bytes(key)).digest()[:16]
+
+
+def rsa_key_id(e, n_modulus):
+    """ Returns a 16 byte identifier for an RSA public key. """
+    n_bytes = n_modulus.to_bytes((n_modulus.bit_length() + 7) // 8, 'big')
+    return hashlib.sha256(b'image-encryption rsa key id\x00' + e.to_bytes(4, 'big') + n_bytes).digest()[:16]
+
+
+def pack_header(header):
+    dtype = np.dtype(header.dtype)
+    if dtype.hasobject:
+        raise ValueError('object arrays cannot be stored in a container')
+    assert len(header.shape) <= MAX_DIMS
+    shape = tuple(header.shape) + (0,) * (MAX_DIMS - len(header.shape))
+    return HEADER.pack(MAGIC, VERSION, ALGORITHMS[header.algorithm], len(header.shape), dtype.str.encode(),
+                       header.key_id, header.iv, header.tag, *shape, header.payload_length)
+
+
+def read_header(buffer):
+    """ Parses the header at the start of `buffer` (at least `HEADER.size` bytes). """
+    magic, version, algorithm, ndim, dtype, key, iv, tag, *rest = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'not a version {VERSION} image container')
+    shape, payload_length = rest[:MAX_DIMS], rest[MAX_DIMS]
+    return Header(ALGORITHM_NAMES[algorithm], np.dtype(dtype.rstrip(b'\x00').decode()),
+                  tuple(shape[:ndim]), key, iv, tag, payload_length)
+
+
+def read_file_header(path):
+    """ Reads only the header of a container file.  """
+    with open(path, 'rb') as container_file:
+        return read_header(container_file.read(HEADER.size))
+
+
+def split(buffer):
+    """ Returns (header, payload) where payload is a memoryview into `buffer`. """
+    header = read_header(buffer)
+    view = memoryview(buffer).cast('B')
+    payload = view[HEADER.size:HEADER.size + header.payload_length]
+    if len(payload) != header.payload_length:
+        raise ValueError('truncated image container')
+    return header, payload
+
+
+def map_file(path):
+    """
+    Memory-maps a container file and returns (header, payload memoryview).
+    The mapping stays open as long as the payload view is referenced.
+    """
+    with open(path, 'rb') as container_file:
+        mapped = mmap.mmap(container_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return split(mapped)
+
+
+def _authenticated_header(header):
+    """ Header bytes with a zero tag, authenticated as GCM associated data. """
+    return pack_header(header._replace(tag=bytes(16)))
+
+
+def encrypt_array(arr, key, algorithm='aes-ctr', iv=None):
+    """
+    Encrypts the array `arr` (e.g. a decoded HxWxC image or raw file bytes)
+    with AES and returns the container bytes.
+    """
+    arr = np.ascontiguousarray(arr)
+    cipher = AES(key)
+    header = Header(algorithm, arr.dtype, arr.shape, key_id(key), b'', bytes(16), arr.nbytes)
+    if algorithm == 'aes-ctr':
+        header = header._replace(iv=iv or os.urandom(16))
+        payload = cipher.encrypt_ctr(arr, header.iv)
+    elif algorithm == 'aes-gcm':
+        header = header._replace(iv=iv or os.urandom(12) + bytes(4))
+        payload, tag = cipher.encrypt_gcm(arr, header.iv[:12], _authenticated_header(header))
+        header = header._replace(tag=tag)
+    else:
+        raise ValueError(f'unsupported AES algorithm {algorithm}')
+    return pack_header(header) + payload
+
+
+def encrypt_rsa_image(img, e, n_modulus):
+    """ Encrypts a uint8 image with `encrypt_rsa` and returns the container bytes. """
+    from encrypt_rsa import image_encryption
+    ciphertext = image_encryption(img, e, n_modulus, img.shape[0], img.shape[1])
+    header = Header('rsa', ciphertext.dtype, ciphertext.shape, rsa_key_id(e, n_modulus), bytes(16), bytes(16),
+                    ciphertext.nbytes)
+    return pack_header(header) + ciphertext.tobytes()
+
+
+def decrypt_array(buffer, key):
+    """
+    Decrypts a container into an array of its recorded shape. `key` is the
+    AES key, or an `encrypt_rsa.RSAPrivateKey` for RSA containers.
+    """
+    header, payload = split(buffer)
+    if header.algorithm == 'rsa':
+        from encrypt_rsa import image_decryption_crt
+        if header.key_id != rsa_key_id(key.e, key.n_modulus):
+            raise ValueError('container was encrypted with a different RSA key')
+        ciphertext = np.frombuffer(payload, dtype=header.dtype).reshape(header.shape)
+        return image_decryption_crt(ciphertext, key, header.shape[0], header.shape[1])
+
+    if header.key_id != key_id(key):
+        raise ValueError('container was encrypted with a different AES key')
+    if header.algorithm == 'aes-gcm':
+        plaintext = AES(key).decrypt_gcm(payload, header.iv[:12], header.tag, _authenticated_header(header))
+    else:
+        plaintext = AES(key).decrypt_ctr(payload, header.iv)
+    return np.frombuffer(plaintext, dtype=header.dtype).reshape(header.shape)
@@ -1,6 +1,10 @@
 import logging
+import math
+import numpy as np
 from rsa import randnum
 
+from instrument import stage, timed
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('RSA')
 
@@ -24,61 +28,276 @@ def gcd_extended(x, n):
         return "No Inverse"
 
 
+@timed('rsa.modular_exponentiation')
 def modular_exponentiation(a, d, n):
-    r = 1
+    # Both operands stay reduced mod n, so one reduction per product is enough.
+    r = 1 % n
+    a %= n
     while d != 0:
-        if d % 2 == 1:
-            r = ((r % n) * (a % n)) % n
-        a = ((a % n) * (a % n)) % n
+        if d & 1:
+            r = (r * a) % n
+        a = (a * a) % n
         d >>= 1
     return r
 
 def is_prime(a):
     return not (a < 2 or any(a % x == 0 for x in range(2, int(a ** 0.5) + 1)))
 
-def get_prime(n):
+
+def sieve(limit):
+    """ Returns the primes below limit (sieve of Eratosthenes). """
+    flags = bytearray([1]) * limit
+    flags[:2] = b'\x00\x00'
+    for i in range(2, int(limit ** 0.5) + 1):
+        if flags[i]:
+            flags[i * i::i] = bytes(len(range(i * i, limit, i)))
+    return [i for i, flag in enumerate(flags) if flag]
+
+
+SMALL_PRIMES = sieve(2000)
+MILLER_RABIN_ROUNDS = 40
+
+
+def miller_rabin(n, rounds=MILLER_RABIN_ROUNDS):
+    """ Miller-Rabin probable prime test with `rounds` random bases, for odd n > 3. """
+    d = n - 1
+    s = 0
+    while d % 2 == 0:
+        d >>= 1
+        s += 1
+    for _ in range(rounds):
+        a = randnum.randint(n - 3) + 1  # randint is in [1, n - 3], so the base is in [2, n - 2]
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def is_probable_prime(a, rounds=MILLER_RABIN_ROUNDS):
+    """
+    Rejects candidates divisible by a small prime, then runs Miller-Rabin
+    on the survivors.
+    """
+    if a < 2:
+        return False
+    for p in SMALL_PRIMES:
+        if a % p == 0:
+            return a == p
+    if a < SMALL_PRIMES[-1] ** 2:
+        return True
+    return miller_rabin(a, rounds)
+
+
+def get_prime(n, rounds=MILLER_RABIN_ROUNDS):
     while True:
         integer = randnum.read_random_odd_int(n)
 
         # Test for primeness
-        if is_prime(integer):
+        if is_probable_prime(integer, rounds):
             return integer
-def gen_keys(length: int):
-    p_prime = get_prime(length)
-    q_prime = get_prime(length)
+
+
+@timed('rsa.gen_keys')
+def gen_keys(length: int, rounds=MILLER_RABIN_ROUNDS):
     e = 65537  # This is standard for E
+    while True:
+        p_prime = get_prime(length, rounds)
+        q_prime = get_prime(length, rounds)
+        euler_totient = (p_prime - 1) * (q_prime - 1)
+        # Retry until e is invertible, so d_private is always a number.
+        if p_prime != q_prime and math.gcd(e, euler_totient) == 1:
+            break
     n_modulus = p_prime * q_prime
-    euler_totient = (p_prime - 1) * (q_prime - 1)
     d_private = gcd_extended(e, euler_totient)
     return p_prime, q_prime, e, n_modulus, d_private
 
 
-enc = [[0 for x in range(3000)] for y in range(3000)]
+# Largest slot table searched by `RSAPrivateKey.slot_table`.
+SLOT_TABLE_MAX = 1 << 20
+
+
+class RSAPrivateKey:
+    """
+    RSA private key with the Chinese Remainder Theorem values precomputed,
+    so decryption runs two half-size exponentiations mod p and mod q.
+    """
+
+    def __init__(self, p_prime, q_prime, e, d_private):
+        self.p_prime = p_prime
+        self.q_prime = q_prime
+        self.e = e
+        self.d_private = d_private
+        self.n_modulus = p_prime * q_prime
+        self.d_p = d_private % (p_prime - 1)
+        self.d_q = d_private % (q_prime - 1)
+        self.q_inv = pow(q_prime, -1, p_prime)
+        self._plaintext_table = None
+        self._slot_table = None
+
+    def plaintext_table(self):
+        """
+        Returns (sorted ciphertexts of every channel value, their plaintexts),
+        built once per key from `encryption_table`.
+        """
+        if self._plaintext_table is None:
+            table = encryption_table(self.e, self.n_modulus)[:min(256, self.n_modulus)]
+            order = np.argsort(table, kind='stable')
+            self._plaintext_table = table[order], order.astype(cipher_dtype(self.n_modulus))
+        return self._plaintext_table
+
+    def slot_table(self):
+        """
+        Returns (m, ciphertexts, plaintexts) with the ciphertext of every
+        channel value, and its plaintext, at index `ciphertext % m`, where m
+        is the smallest size of at least 256 without collisions. None when
+        ciphertexts are not native integers or no m up to `SLOT_TABLE_MAX` fits.
+        """
+        if self._slot_table is None:
+            known, plaintexts = self.plaintext_table()
+            if known.dtype.hasobject:
+                return None
+            for m in range(len(known), SLOT_TABLE_MAX + 1):
+                slots = known % known.dtype.type(m)
+                if np.bincount(slots, minlength=m).max() <= 1:
+                    ciphertexts = np.zeros(m, dtype=known.dtype)
+                    # An empty slot 0 must not match a zero ciphertext; 1 is never stored there.
+                    ciphertexts[0] = 1
+                    ciphertexts[slots] = known
+                    table = np.zeros(m, dtype=plaintexts.dtype)
+                    table[slots] = plaintexts
+                    self._slot_table = (m, ciphertexts, table)
+                    break
+            else:
+                self._slot_table = False
+        return self._slot_table or None
+
+    def decrypt(self, c):
+        """ Decrypts a single integer ciphertext (Garner's recombination). """
+        m_p = pow(c, self.d_p, self.p_prime)
+        m_q = pow(c, self.d_q, self.q_prime)
+        h = (self.q_inv * (m_p - m_q)) % self.p_prime
+        return m_q + h * self.q_prime
+
+
+def cipher_dtype(n_modulus):
+    """
+    Returns the smallest unsigned integer dtype that holds every value below
+    n_modulus, or object for moduli wider than 64 bits.
+    """
+    if n_modulus - 1 <= np.iinfo(np.uint64).max:
+        return np.min_scalar_type(n_modulus - 1)
+    return np.dtype(object)
 
 
-def image_encryption(img, e, n_modulus, row, col):
+def encryption_table(e, n_modulus):
+    """ Returns the ciphertext of every channel value 0..255 for the public key. """
+    return np.array([pow(v, e, n_modulus) for v in range(256)], dtype=cipher_dtype(n_modulus))
+
+
+def decrypt_values(ciphertext, d_private, n_modulus):
+    """
+    Decrypts an array of ciphertext values. Each distinct value is only
+    decrypted once and the results are scattered back with one lookup.
+    """
+    return _decrypt_distinct(ciphertext, lambda c: pow(c, d_private, n_modulus), n_modulus)
+
+
+def decrypt_values_crt(ciphertext, private_key):
+    """
+    Same as `decrypt_values`, mapping every value through the key's
+    `slot_table`, or its `plaintext_table` with a binary search when there
+    is none. Values that are not the ciphertext of a channel value are
+    decrypted with CRT.
+    """
+    flat = np.asarray(ciphertext).reshape(-1)
+    slot_table = private_key.slot_table()
+    if slot_table is not None:
+        m, ciphertexts, plaintexts = slot_table
+        slots = flat % ciphertexts.dtype.type(m)
+        out = plaintexts[slots]
+        missing = ciphertexts[slots] != flat
+    else:
+        known, plaintexts = private_key.plaintext_table()
+        index = np.minimum(np.searchsorted(known, flat), len(known) - 1)
+        out = plaintexts[index]
+        missing = known[index] != flat
+    if missing.any():
+        out[missing] = _decrypt_distinct(flat[missing], private_key.decrypt, private_key.n_modulus)
+    return out.reshape(np.shape(ciphertext))
+
+
+def _decrypt_distinct(ciphertext, decrypt, n_modulus):
+    values, inverse = np.unique(ciphertext, return_inverse=True)
+    table = np.array([decrypt(int(c)) for c in values], dtype=cipher_dtype(n_modulus))
+    return table[inverse].reshape(ciphertext.shape)
+
+
+def ciphertext_preview(ciphertext):
+    """ Returns the displayable uint8 image of a ciphertext (each value mod 256). """
+    return (ciphertext % 256).astype(np.uint8)
+
+
+# Rows mapped per step when image_encryption reports progress.
+PROGRESS_ROWS = 256
+
+
+def image_encryption(img, e, n_modulus, row, col, progress=None):
+    """
+    Encrypts the top-left row x col pixels of img and returns the ciphertext
+    as an array of exactly that shape, using the smallest dtype for n_modulus.
+    If given, `progress(done_rows, row)` is called every `PROGRESS_ROWS` rows.
+    """
+    with stage('rsa.image_encryption', n_bytes=img[:row, :col].nbytes, n_pixels=row * col):
+        table = encryption_table(e, n_modulus)
+        if progress is None:
+            return table[img[:row, :col]]
+
+        ciphertext = np.empty(img[:row, :col].shape, dtype=table.dtype)
+        for i in range(0, row, PROGRESS_ROWS):
+            ciphertext[i:i + PROGRESS_ROWS] = table[img[i:min(i + PROGRESS_ROWS, row), :col]]
+            progress(min(i + PROGRESS_ROWS, row), row)
+        return ciphertext
+
+
+def image_decryption(ciphertext, d_private, n_modulus, row, col):
+    """ Decrypts a ciphertext from `image_encryption` into a uint8 image. """
+    with stage('rsa.image_decryption', n_bytes=ciphertext[:row, :col].nbytes, n_pixels=row * col):
+        return decrypt_values(ciphertext[:row, :col], d_private, n_modulus).astype(np.uint8)
+
+
+def image_decryption_crt(ciphertext, private_key, row, col):
+    """ Decrypts a ciphertext from `image_encryption` with an `RSAPrivateKey`. """
+    with stage('rsa.image_decryption_crt', n_bytes=ciphertext[:row, :col].nbytes, n_pixels=row * col):
+        return decrypt_values_crt(ciphertext[:row, :col], private_key).astype(np.uint8)
+
+
+def image_encryption_reference(img, e, n_modulus, row, col):
+    enc = np.zeros((row, col, 3), dtype=cipher_dtype(n_modulus))
     for i in range(0, row):
         for j in range(0, col):
-            red, green, blue = img[i, j]
+            red, green, blue = (int(v) for v in img[i, j])
             c_r = modular_exponentiation(red, e, n_modulus)
             c_g = modular_exponentiation(green, e, n_modulus)
             c_b = modular_exponentiation(blue, e, n_modulus)
-            enc[i][j] = [c_r, c_g, c_b]
-            c_r = c_r % 256
-            c_g = c_g % 256
-            c_b = c_b % 256
             # logger.info(f'encrypted array {red} {green} {blue} -> {c_r} {c_g} {c_b}')
-            img[i, j] = [c_r, c_g, c_b]
-    return img
+            enc[i, j] = [c_r, c_g, c_b]
+    return enc
 
 
-def image_decryption(img, d_private, n_modulus, row, col):
+def image_decryption_reference(ciphertext, d_private, n_modulus, row, col):
+    img = np.zeros((row, col, 3), dtype=np.uint8)
     for i in range(0, row):
         for j in range(0, col):
-            red, green, blue = enc[i][j]
+            red, green, blue = (int(v) for v in ciphertext[i, j])
             m_r = modular_exponentiation(red, d_private, n_modulus)
             m_g = modular_exponentiation(green, d_private, n_modulus)
             m_b = modular_exponentiation(blue, d_private, n_modulus)
             # logger.info(f'decrypted array {red} {green} {blue} -> {m_r} {m_g} {m_b}')
             img[i, j] = [m_r, m_g, m_b]
-    return img
\ No newline at end of file
+    return img
@@ -1,34 +1,16 @@
 import cv2
-import io
-import math
+from concurrent.futures import ThreadPoolExecutor
 import os
+import queue
 import logging
 import PySimpleGUIQt as sg
+import numpy as np
 from PIL import Image
-from encrypt_rsa2 import gen_keys, image_encryption, image_decryption
+from encrypt_rsa import gen_keys, image_encryption, image_decryption_crt, ciphertext_preview, RSAPrivateKey
 from aes import AES
-import base64
-
-
-def resize_image(image_path, resize=None):
-    if isinstance(image_path, str):
-        img = Image.open(image_path)
-    else:
-        try:
-            img = Image.open(io.BytesIO(base64.b64decode(image_path)))
-        except Exception as e:
-            data_bytes_io = io.BytesIO(image_path)
-            img = Image.open(data_bytes_io)
-
-    cur_width, cur_height = img.size
-    if resize:
-        new_width, new_height = resize
-        scale = min(new_height/cur_height, new_width/cur_width)
-        img = img.resize((int(cur_width*scale), int(cur_height*scale)), Image.ANTIALIAS)
-    bio = io.BytesIO()
-    img.save(bio, format="PNG")
-    del img
-    return bio.getvalue()
+from preview import resize_image, array_preview
+import instrument
+from instrument import stage
 
 
 class Handler(logging.StreamHandler):
@@ -56,6 +38,10 @@ row = None
 col = None
 image_encrypted = False
 input_data = False
+job_running = False
+
+# How often the event loop checks for job events while a job is running, in ms.
+JOB_POLL_MS = 100
 
 file_types = [("JPEG (*.jpeg)", "*.jpeg"),
               ("All files (*.*)", "*.*")]
@@ -79,11 +65,68 @@ layout = [
         sg.Button("AES Decrypt"),
     ],
     [sg.Output(size=(70, 2), key='log')],
+    [sg.ProgressBar(100, orientation='h', size=(35, 10), key='-PROGRESS-')],
     [sg.Button("Generate AES Key"), sg.Input(size=(25, 1), key="-GENKEY-")],
     [sg.Button("Generate AES IV"), sg.Input(size=(25, 1), key="-GENIV-")],
 [sg.Image(key="-IMAGE-"), sg.Image(key="-IMAGE_MODIFIED-")],
 ]
 
+
+def report_progress(done, total):
+    """ Posts the percentage done of the running job back to the event loop. """
+    job_events.put(('-JOB-PROGRESS-', int(100 * done / total) if total else 100))
+
+
+def rsa_encrypt_job(filename):
+    with stage('codec.decode'):
+        rgb_img = cv2.imread(filename)
+    row, col = rgb_img.shape[0], rgb_img.shape[1]
+    keys = gen_keys(7)
+    p_prime, q_prime, e, n_modulus, d_private = keys
+    encrypted = image_encryption(rgb_img, e, n_modulus, row, col, progress=report_progress)
+    return keys, row, col, encrypted, array_preview(ciphertext_preview(encrypted), resize=(400, 400))
+
+
+def rsa_decrypt_job(encrypted, private_key, row, col):
+    decrypted_img = image_decryption_crt(encrypted, private_key, row, col)
+    return array_preview(decrypted_img, resize=(400, 400))
+
+
+def aes_encrypt_job(filename, aes_key, iv):
+    # decode once and encrypt the pixels themselves, so the preview needs no codec round trip
+    with stage('codec.decode'):
+        pixels = np.asarray(Image.open(filename).convert('RGB'))
+    cyphertext = AES(aes_key).encrypt_pixels(pixels, iv, progress=report_progress)
+    return cyphertext, array_preview(cyphertext, resize=(400, 400))
+
+
+def aes_decrypt_job(cyphertext, aes_key, iv):
+    decrypted_img = AES(aes_key).decrypt_pixels(cyphertext, iv, progress=report_progress)
+    return array_preview(decrypted_img, resize=(400, 400))
+
+
+def start_job(name, fn, *args):
+    """
+    Runs `fn(*args)` on the worker thread and queues `(name, result)` as a
+    -JOB-DONE- event, or `(name, exception)` as -JOB-ERROR-, for the event
+    loop to pick up.
+    """
+    global job_running
+    if job_running:
+        logging.info('Busy, wait for the current operation to finish')
+        return
+
+    def run():
+        try:
+            job_events.put(('-JOB-DONE-', (name, fn(*args))))
+        except Exception as exc:
+            job_events.put(('-JOB-ERROR-', (name, exc)))
+
+    job_running = True
+    window['-PROGRESS-'].update_bar(0)
+    executor.submit(run)
+
+
 window = sg.Window("Image Encryption", layout)
 
 logging.basicConfig(level=logging.INFO)
@@ -92,8 +135,18 @@ ch = Handler()
 ch.setLevel(logging.INFO)
 logging.getLogger('').addHandler(ch)
 
+# Crypto work runs here so the event loop never blocks on it.
+executor = ThreadPoolExecutor(max_workers=1)
+# The Qt port has no write_event_value, so the worker hands events back through this queue.
+job_events = queue.Queue()
+
 while True:
-    event, values = window.read(timeout=0)
+    try:
+        event, payload = job_events.get_nowait()
+        values = {event: payload}
+    except queue.Empty:
+        # Only poll while a job can post events; otherwise block until the user acts.
+        event, values = window.read(timeout=JOB_POLL_MS if job_running else None)
     if event == "Exit" or event == sg.WIN_CLOSED:
         break
     if event == "Generate AES Key":
@@ -105,80 +158,56 @@ while True:
     if event == "Load Image":
         filename = values["-FILE-"]
         if os.path.exists(filename):
-            image = Image.open(values["-FILE-"])
-            # image.thumbnail((400, 400))
-            bio = io.BytesIO()
-            # Actually store the image in memory in binary 
-            image.save(bio, format="PNG")
-            # Use that image data in order to 
-            window["-IMAGE-"].update(data=resize_image(bio.getvalue(), resize=(400, 400)))
+            window["-IMAGE-"].update(data=resize_image(filename, resize=(400, 400)))
             logging.info('Loaded Image to Console')
     if event == "RSA Encrypt":
         filename = values["-FILE-"]
         if os.path.exists(filename):
-            rgb_img = cv2.imread(filename)
-            row, col = rgb_img.shape[0], rgb_img.shape[1]
-            p_prime, q_prime, e, n_modulus, d_private = gen_keys(7)
-            ENCRYPTED_IMAGE = image_encryption(rgb_img, e, n_modulus, row, col)
-            image = Image.fromarray(ENCRYPTED_IMAGE)
-            # image = Image.open(data)
-            bio = io.BytesIO()
-            # Actually store the image in memory in binary
-            image.save(bio, format="JPEG")
-            image_encrypted = True
-            # Use that image data in order to
-            window["-IMAGE_MODIFIED-"].update(data=resize_image(bio.getvalue(), resize=(400, 400)))
-            logging.info('Encrypted RSA')
+            start_job('RSA Encrypt', rsa_encrypt_job, filename)
     if event == "RSA Decrypt":
-        if image_encrypted:
-            decrypted_img = image_decryption(ENCRYPTED_IMAGE, d_private, n_modulus, row, col)
-            image = Image.fromarray(decrypted_img)
-            bio = io.BytesIO()
-            # Actually store the image in memory in binary
-            image.save(bio, format="JPEG")
-            ENCRYPTED_IMAGE = None
-            # Use that image data in order to
-            window["-IMAGE_MODIFIED-"].update(data=resize_image(bio.getvalue(), resize=(400, 400)))
-            logging.info('Decrypted RSA')
+        if image_encrypted and ENCRYPTED_IMAGE is not None:
+            private_key = RSAPrivateKey(p_prime, q_prime, e, d_private)
+            start_job('RSA Decrypt', rsa_decrypt_job, ENCRYPTED_IMAGE, private_key, row, col)
     if event == "AES Encrypt":
         filename = values["-FILE-"]
         if os.path.exists(filename):
             aes_key = os.urandom(16) if not aes_key else aes_key
             iv = os.urandom(16) if not iv else iv
-            # opening image
-            input_file = open(filename, 'rb')
-            input_data = input_file.read()
-            input_file.close()
-
-            # encrypting our image
-            cyphertext = AES(aes_key).encrypt_ctr(input_data, iv)
-            # preparing our image for showing
-            num_bytes = len(cyphertext)
-            num_pixels = int((num_bytes + 2) / 3)  # 3 bytes per pixel
-            W = H = int(math.ceil(num_pixels ** 0.5))
-            fill_bytes = '\0' * (W * H * 3 - len(cyphertext))
-            imagedata = cyphertext + fill_bytes.encode('utf-8')
-            # image from bytes
-            image = Image.frombytes('RGB', (W, H), imagedata, 'raw')
-            # image = Image.open(data)
-            bio = io.BytesIO()
-            # Actually store the image in memory in binary
-            image.save(bio, format="PNG")
+            start_job('AES Encrypt', aes_encrypt_job, filename, aes_key, iv)
+    if event == "AES Decrypt":
+        if cyphertext is not None:
+            start_job('AES Decrypt', aes_decrypt_job, cyphertext, aes_key, iv)
+    if event == '-JOB-PROGRESS-':
+        window['-PROGRESS-'].update_bar(values[event])
+    if event == '-JOB-ERROR-':
+        job_running = False
+        name, exc = values[event]
+        logging.error(f'{name} failed: {exc}')
+    if event == '-JOB-DONE-':
+        job_running = False
+        name, result = values[event]
+        window['-PROGRESS-'].update_bar(100)
+        if name == 'RSA Encrypt':
+            (p_prime, q_prime, e, n_modulus, d_private), row, col, ENCRYPTED_IMAGE, preview = result
             image_encrypted = True
-            # Use that image data in order to
-            window["-IMAGE_MODIFIED-"].update(data=resize_image(bio.getvalue(), resize=(400, 300)))
+            window["-IMAGE_MODIFIED-"].update(data=preview)
+            logging.info('Encrypted RSA')
+        if name == 'RSA Decrypt':
+            ENCRYPTED_IMAGE = None
+            window["-IMAGE_MODIFIED-"].update(data=result)
+            logging.info('Decrypted RSA')
+        if name == 'AES Encrypt':
+            cyphertext, preview = result
+            image_encrypted = True
+            window["-IMAGE_MODIFIED-"].update(data=preview)
             logging.info('Encrypted AES')
-    if event == "AES Decrypt":
-        if cyphertext:
-            decrypted_img = AES(aes_key).decrypt_ctr(cyphertext, iv)
-            image = Image.open(io.BytesIO(decrypted_img))
-            bio = io.BytesIO()
-            # Actually store the image in memory in binary
-            image.save(bio, format="PNG")
+        if name == 'AES Decrypt':
             cyphertext = None
-            # Use that image data in order to
-            window["-IMAGE_MODIFIED-"].update(data=resize_image(bio.getvalue(), resize=(400, 400)))
+            window["-IMAGE_MODIFIED-"].update(data=result)
             logging.info('Decrypted AES')
+        if instrument.enabled:
+            instrument.stats.log()
+            instrument.stats.reset()
     if event == "RESET UI":
         logging.info('Clearing Console')
         window["-IMAGE-"].update('')
@@ -199,4 +228,5 @@ while True:
         image_encrypted = False
         input_data = False
 
+executor.shutdown(wait=False)
 window.close()
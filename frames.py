@@ -0,0 +1,347 @@
+"""
+Pipelined encryption of videos and image sequences, frame by frame.
+
+    python frames.py encrypt --mode aes -k aes.key -i clip.mp4 -o encrypted/
+    python frames.py decrypt --mode aes -k aes.key -i encrypted/ -o decrypted.avi
+
+Decoding, encryption and encoding run on their own threads, joined by
+bounded queues, so the OpenCV codecs (which release the GIL) overlap with
+the cipher and throughput is set by the slowest stage.
+
+Encrypted frames are written as lossless images (`.png` for 8 and 16 bit
+ciphertexts, `.npy` otherwise) next to a `frames.json` manifest holding the
+IV, key id, frame rate and, for every frame, its file, shape and the AES-CTR
+counter block it starts at. All frames share one IV; each frame starts on
+the block after the previous one ends, so any frame can be decrypted alone.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from aes import AES
+import container
+import instrument
+from instrument import stage
+from encrypt_rsa import cipher_dtype, image_encryption, image_decryption_crt, RSAPrivateKey
+
+logger = logging.getLogger('frames')
+
+# Frames buffered between two stages.
+FRAME_QUEUE_SIZE = 8
+
+MANIFEST_NAME = 'frames.json'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+VIDEO_CODECS = {'.avi': 'MJPG', '.mp4': 'mp4v', '.mkv': 'MJPG'}
+PNG_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+_DONE = object()
+
+
+def read_video(path):
+    """ Yields the frames of a video file decoded with `cv2.VideoCapture`. """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f'cannot open video {path}')
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+def read_image_sequence(paths, flags=cv2.IMREAD_COLOR):
+    """ Yields the decoded images (`.npy` arrays are loaded) of `paths` in order. """
+    for path in paths:
+        if path.endswith('.npy'):
+            frame = np.load(path)
+        else:
+            frame = cv2.imread(path, flags)
+        if frame is None:
+            raise ValueError(f'cannot decode image {path}')
+        yield frame
+
+
+def sequence_paths(directory):
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if name.lower().endswith(IMAGE_EXTENSIONS)]
+
+
+def video_fps(path):
+    capture = cv2.VideoCapture(path)
+    try:
+        return capture.get(cv2.CAP_PROP_FPS) or 0.0
+    finally:
+        capture.release()
+
+
+def run_pipeline(frames, transform, write, queue_size=FRAME_QUEUE_SIZE):
+    """
+    Pulls frames from the iterable `frames` (decode), passes each through
+    `transform(index, frame)` (encrypt) and hands the result to
+    `write(index, result)` (encode), each on its own thread with at most
+    `queue_size` frames waiting between two stages. Returns the number of
+    frames written; the first exception of any stage is re-raised.
+    """
+    stop = threading.Event()
+    errors = []
+    decoded = queue.Queue(queue_size)
+    transformed = queue.Queue(queue_size)
+    written = [0]
+
+    def put(target, item):
+        while not stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(source):
+        while not stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def decode_stage():
+        iterator = iter(frames)
+        index = 0
+        while True:
+            with stage('frames.decode'):
+                frame = next(iterator, _DONE)
+            if frame is _DONE or not put(decoded, (index, frame)):
+                break
+            index += 1
+        put(decoded, _DONE)
+
+    def transform_stage():
+        while True:
+            item = get(decoded)
+            if item is _DONE:
+                break
+            index, frame = item
+            with stage('frames.encrypt', n_bytes=frame.nbytes, n_pixels=frame.shape[0] * frame.shape[1]):
+                result = transform(index, frame)
+            if not put(transformed, (index, result)):
+                break
+        put(transformed, _DONE)
+
+    def encode_stage():
+        while True:
+            item = get(transformed)
+            if item is _DONE:
+                break
+            with stage('frames.encode'):
+                write(*item)
+            written[0] += 1
+
+    def guarded(fn):
+        def run():
+            try:
+                fn()
+            except BaseException as exc:
+                errors.append(exc)
+                stop.set()
+        return run
+
+    threads = [threading.Thread(target=guarded(fn), name=f'frames-{fn.__name__}', daemon=True)
+               for fn in (decode_stage, transform_stage, encode_stage)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return written[0]
+
+
+class AESFrameCipher:
+    """
+    AES-CTR over a sequence of frames sharing one IV. Frames must be
+    encrypted in order; each starts at the counter block after the previous
+    frame and records it in `counters`.
+    """
+
+    def __init__(self, key, iv):
+        self.cipher = AES(key)
+        self.iv = iv
+        self.next_block = 0
+        self.counters = []
+
+    def apply(self, frame, counter):
+        """ XORs a frame with the keystream starting at counter block `counter`. """
+        data = np.ascontiguousarray(frame).reshape(-1).view(np.uint8)
+        keystream = self.cipher.ctr_keystream(self.iv, counter, (len(data) + 15) // 16)
+        return np.bitwise_xor(data, keystream[:len(data)]).view(frame.dtype).reshape(frame.shape)
+
+    def encrypt(self, index, frame):
+        counter = self.next_block
+        self.next_block += (frame.nbytes + 15) // 16
+        self.counters.append(counter)
+        return self.apply(frame, counter)
+
+
+def _frame_name(index, dtype):
+    extension = '.png' if np.dtype(dtype) in (np.uint8, np.uint16) else '.npy'
+    return f'frame_{index:06d}{extension}'
+
+
+def write_frame(path, frame):
+    if path.endswith('.npy'):
+        np.save(path, frame, allow_pickle=False)
+    elif not cv2.imwrite(path, frame, PNG_PARAMS):
+        raise ValueError(f'cannot encode image {path}')
+
+
+def encrypt_frames(source, output_dir, mode, key, iv=None, queue_size=FRAME_QUEUE_SIZE):
+    """
+    Encrypts every frame of a video file or image directory `source` into
+    `output_dir` and writes its manifest. `key` is an AES key, or a dict
+    with 'e' and 'n' for RSA, whose modulus must fit in 64 bits. Returns the
+    manifest.
+    """
+    if mode == 'rsa' and cipher_dtype(key['n']).hasobject:
+        raise ValueError('RSA moduli wider than 64 bits are not supported')
+    os.makedirs(output_dir, exist_ok=True)
+    if os.path.isdir(source):
+        frames, fps = read_image_sequence(sequence_paths(source)), 0.0
+    else:
+        frames, fps = read_video(source), video_fps(source)
+
+    manifest = {'mode': mode, 'fps': fps, 'frames': []}
+    if mode == 'aes':
+        frame_cipher = AESFrameCipher(key, iv or os.urandom(16))
+        manifest.update(algorithm='aes-ctr', iv=frame_cipher.iv.hex(), key_id=container.key_id(key).hex())
+        transform = frame_cipher.encrypt
+    else:
+        manifest.update(algorithm='rsa', key_id=container.rsa_key_id(key['e'], key['n']).hex())
+
+        def transform(index, frame):
+            return image_encryption(frame, key['e'], key['n'], frame.shape[0], frame.shape[1])
+
+    def write(index, frame):
+        name = _frame_name(index, frame.dtype)
+        write_frame(os.path.join(output_dir, name), frame)
+        manifest['frames'].append({'file': name, 'shape': list(frame.shape), 'dtype': frame.dtype.str})
+
+    run_pipeline(frames, transform, write, queue_size)
+    if mode == 'aes':
+        for entry, counter in zip(manifest['frames'], frame_cipher.counters):
+            entry['counter'] = counter
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST_NAME)) as manifest_file:
+        return json.load(manifest_file)
+
+
+class FrameSink:
+    """ Writes frames as a video file (by extension) or as a numbered PNG sequence. """
+
+    def __init__(self, output, fps):
+        self.output = output
+        self.fps = fps or 25.0
+        self.writer = None
+        extension = os.path.splitext(output)[1].lower()
+        self.codec = VIDEO_CODECS.get(extension)
+        if self.codec is None:
+            os.makedirs(output, exist_ok=True)
+
+    def write(self, index, frame):
+        if self.codec is None:
+            write_frame(os.path.join(self.output, f'frame_{index:06d}.png'), frame)
+            return
+        if self.writer is None:
+            height, width = frame.shape[:2]
+            self.writer = cv2.VideoWriter(self.output, cv2.VideoWriter_fourcc(*self.codec), self.fps, (width, height))
+            if not self.writer.isOpened():
+                raise ValueError(f'cannot open video writer for {self.output}')
+        self.writer.write(frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+
+
+def decrypt_frames(source_dir, output, key, queue_size=FRAME_QUEUE_SIZE):
+    """
+    Decrypts the frames written by `encrypt_frames` into a video file or
+    PNG directory `output`. `key` is the AES key, or an
+    `encrypt_rsa.RSAPrivateKey`. Returns the number of frames.
+    """
+    manifest = read_manifest(source_dir)
+    entries = manifest['frames']
+    paths = [os.path.join(source_dir, entry['file']) for entry in entries]
+    frames = read_image_sequence(paths, cv2.IMREAD_UNCHANGED)
+
+    if manifest['algorithm'] == 'aes-ctr':
+        if bytes.fromhex(manifest['key_id']) != container.key_id(key):
+            raise ValueError(f'{source_dir} was encrypted with a different AES key')
+        frame_cipher = AESFrameCipher(key, bytes.fromhex(manifest['iv']))
+
+        def transform(index, frame):
+            return frame_cipher.apply(frame, entries[index]['counter'])
+    else:
+        if bytes.fromhex(manifest['key_id']) != container.rsa_key_id(key.e, key.n_modulus):
+            raise ValueError(f'{source_dir} was encrypted with a different RSA key')
+
+        def transform(index, frame):
+            return image_decryption_crt(frame, key, frame.shape[0], frame.shape[1])
+
+    sink = FrameSink(output, manifest['fps'])
+    try:
+        return run_pipeline(frames, transform, sink.write, queue_size)
+    finally:
+        sink.close()
+
+
+def main(argv=None):
+    from batch_encrypt import load_key
+
+    parser = argparse.ArgumentParser(description='Pipelined frame-by-frame encryption of videos and image sequences.')
+    parser.add_argument('command', choices=('encrypt', 'decrypt'))
+    parser.add_argument('--mode', choices=('aes', 'rsa'), default='aes')
+    parser.add_argument('-k', '--key', required=True, help='key file written by batch_encrypt.py keygen')
+    parser.add_argument('-i', '--input', required=True, help='video file or image directory (encrypted directory to decrypt)')
+    parser.add_argument('-o', '--output', required=True, help='output directory, or a video file when decrypting')
+    parser.add_argument('--queue-size', type=int, default=FRAME_QUEUE_SIZE)
+    parser.add_argument('--stats', action='store_true', help='report per-stage timings')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.stats:
+        instrument.enable()
+
+    key = load_key(args.mode, args.key)
+    start = time.perf_counter()
+    if args.command == 'encrypt':
+        n_frames = len(encrypt_frames(args.input, args.output, args.mode, key, queue_size=args.queue_size)['frames'])
+    else:
+        if args.mode == 'rsa':
+            key = RSAPrivateKey(key['p'], key['q'], key['e'], key['d'])
+        n_frames = decrypt_frames(args.input, args.output, key, args.queue_size)
+    elapsed = time.perf_counter() - start
+
+    logger.info(f'{n_frames} frames in {elapsed:.2f}s ({n_frames / elapsed if elapsed else 0.0:.1f} frames/s)')
+    if instrument.enabled:
+        instrument.stats.log(logger)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+Opt-in timing of the hot paths in `aes`, `encrypt_rsa`, `preview` and the
+tools built on them.
+
+Instrumentation is off unless `enable()` is called or the environment
+variable IMAGE_ENCRYPTION_STATS is set. While off, `stage()` returns a shared
+no-op context manager and `timed` functions only test one flag, so the
+instrumented code runs at full speed.
+
+    import instrument
+    instrument.enable()
+    AES(key).encrypt_ctr(data, iv)
+    print(instrument.stats.to_json())
+"""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+enabled = bool(os.environ.get('IMAGE_ENCRYPTION_STATS'))
+
+_NOOP = nullcontext()
+
+
+class Stats:
+    """ Per-stage call counts, seconds, bytes and pixels. Thread-safe. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def record(self, name, seconds, n_bytes=0, n_pixels=0):
+        with self._lock:
+            entry = self._stages.get(name)
+            if entry is None:
+                entry = self._stages[name] = {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'pixels': 0}
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['bytes'] += n_bytes
+            entry['pixels'] += n_pixels
+
+    def merge(self, snapshot):
+        """ Adds a `snapshot()` taken elsewhere, e.g. in a worker process. """
+        with self._lock:
+            for name, other in snapshot.items():
+                entry = self._stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'pixels': 0})
+                for field in ('calls', 'seconds', 'bytes', 'pixels'):
+                    entry[field] += other[field]
+
+    def snapshot(self):
+        """ Returns {stage: {calls, seconds, bytes, pixels, mb_per_s, pixels_per_s}}. """
+        with self._lock:
+            stages = {name: dict(entry) for name, entry in self._stages.items()}
+        for entry in stages.values():
+            seconds = entry['seconds']
+            entry['mb_per_s'] = entry['bytes'] / seconds / 1e6 if entry['bytes'] and seconds else None
+            entry['pixels_per_s'] = entry['pixels'] / seconds if entry['pixels'] and seconds else None
+        return stages
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def lines(self):
+        return snapshot_lines(self.snapshot())
+
+    def log(self, logger=None, level=logging.INFO):
+        """ Logs one line per stage, plus the full snapshot as `extra={'stats': ...}`. """
+        logger = logger or logging.getLogger('stats')
+        snapshot = self.snapshot()
+        for line in self.lines():
+            logger.log(level, line, extra={'stats': snapshot})
+
+
+def snapshot_lines(snapshot):
+    """ Returns one human readable line per stage of a snapshot, slowest first. """
+    lines = []
+    for name, entry in sorted(snapshot.items(), key=lambda item: -item[1]['seconds']):
+        line = f'{name}: {entry["calls"]} calls, {entry["seconds"] * 1000:.1f} ms'
+        if entry['mb_per_s']:
+            line += f', {entry["mb_per_s"]:.1f} MB/s'
+        if entry['pixels_per_s']:
+            line += f', {entry["pixels_per_s"] / 1e6:.2f} Mpx/s'
+        lines.append(line)
+    return lines
+
+
+stats = Stats()
+
+
+class _Stage:
+    __slots__ = ('name', 'n_bytes', 'n_pixels', 'start')
+
+    def __init__(self, name, n_bytes, n_pixels):
+        self.name = name
+        self.n_bytes = n_bytes
+        self.n_pixels = n_pixels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        stats.record(self.name, time.perf_counter() - self.start, self.n_bytes, self.n_pixels)
+
+
+def stage(name, n_bytes=0, n_pixels=0):
+    """ Context manager timing one stage; a shared no-op while disabled. """
+    if not enabled:
+        return _NOOP
+    return _Stage(name, n_bytes, n_pixels)
+
+
+def timed(name):
+    """ Decorator recording every call of the function as stage `name`. """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                stats.record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
@@ -0,0 +1,129 @@
+import base64
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from instrument import timed
+
+# Number of downscaled previews kept by `resize_image`.
+PREVIEW_CACHE_SIZE = 64
+
+_preview_cache = OrderedDict()
+_preview_cache_lock = threading.Lock()
+
+
+def _cached(key):
+    with _preview_cache_lock:
+        data = _preview_cache.get(key)
+        if data is not None:
+            _preview_cache.move_to_end(key)
+        return data
+
+
+def _store(key, data):
+    with _preview_cache_lock:
+        _preview_cache[key] = data
+        _preview_cache.move_to_end(key)
+        while len(_preview_cache) > PREVIEW_CACHE_SIZE:
+            _preview_cache.popitem(last=False)
+
+
+def clear_preview_cache():
+    with _preview_cache_lock:
+        _preview_cache.clear()
+
+
+def _open_image(data):
+    """ Opens encoded image bytes, falling back to base64 encoded image bytes. """
+    try:
+        return Image.open(io.BytesIO(data))
+    except Exception:
+        return Image.open(io.BytesIO(base64.b64decode(data)))
+
+
+def _scaled_size(cur_width, cur_height, resize):
+    new_width, new_height = resize
+    scale = min(new_height/cur_height, new_width/cur_width)
+    return max(1, int(cur_width*scale)), max(1, int(cur_height*scale))
+
+
+def _png(img):
+    bio = io.BytesIO()
+    img.save(bio, format="PNG")
+    return bio.getvalue()
+
+
+@timed('preview.resize_image')
+def resize_image(image_path, resize=None):
+    """
+    Returns PNG bytes of an image path or encoded image bytes, scaled to fit
+    `resize`. JPEGs are decoded at a reduced scale with `draft()`, and the
+    result is cached by content hash and target size.
+    """
+    if isinstance(image_path, str):
+        with open(image_path, 'rb') as image_file:
+            data = image_file.read()
+    else:
+        data = bytes(image_path)
+
+    key = (hashlib.blake2b(data, digest_size=16).digest(), tuple(resize) if resize else None)
+    cached = _cached(key)
+    if cached is not None:
+        return cached
+
+    img = _open_image(data)
+    if resize:
+        # Lets the JPEG decoder skip straight to a 1/2, 1/4 or 1/8 scale at least as large as needed.
+        img.draft('RGB', _scaled_size(*img.size, resize))
+        img = img.resize(_scaled_size(*img.size, resize), Image.LANCZOS)
+    png = _png(img)
+    del img
+    _store(key, png)
+    return png
+
+
+def _sample_step(length, target):
+    """ Stride that keeps at least 2 * target samples along an axis of `length`. """
+    return max(1, length // (2 * target))
+
+
+@timed('preview.array_preview')
+def array_preview(arr, resize=None):
+    """
+    Returns PNG bytes of a uint8 pixel array (HxW or HxWxC), scaled to fit
+    `resize`. The array is first strided down to about twice the target size,
+    so the work does not grow with the image.
+    """
+    if resize:
+        width, height = _scaled_size(arr.shape[1], arr.shape[0], resize)
+        arr = arr[::_sample_step(arr.shape[0], height), ::_sample_step(arr.shape[1], width)]
+    img = Image.fromarray(np.ascontiguousarray(arr))
+    if resize:
+        img = img.resize(_scaled_size(*img.size, resize), Image.LANCZOS)
+    return _png(img)
+
+
+@timed('preview.buffer_preview')
+def buffer_preview(buffer, resize=(400, 400)):
+    """
+    Visualizes an arbitrary (e.g. encrypted) byte buffer as a square RGB
+    image of at most `resize` pixels, built from an evenly strided sample of
+    the buffer rather than the whole of it.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if len(data) < 3:
+        # Too short for one whole pixel; zero pad it to one.
+        data = np.concatenate([data, np.zeros(3 - len(data), dtype=np.uint8)])
+    pixels = len(data) // 3
+    side = max(1, min(int(pixels ** 0.5), *resize))
+    n = side * side
+    step = max(1, pixels // n)
+    # Sample whole 3 byte pixels so each one keeps its original byte triple.
+    rgb = data[:pixels * 3].reshape(-1, 3)[::step][:n]
+    if len(rgb) < n:
+        rgb = np.concatenate([rgb, np.zeros((n - len(rgb), 3), dtype=np.uint8)])
+    return _png(Image.fromarray(rgb.reshape(side, side, 3), 'RGB'))
@@ -0,0 +1,374 @@
+"""
+Local asyncio HTTP service for AES-CTR and RSA pixel encryption.
+
+    python service.py --port 8080
+    python service.py --unix /tmp/image-encryption.sock
+
+Every endpoint takes a POST whose body is the data to transform and answers
+with the result:
+
+    /aes/encrypt, /aes/decrypt    X-Key, X-IV: hex AES key and 16 byte IV
+    /rsa/encrypt                  X-RSA-E, X-RSA-N: body is uint8 pixels,
+                                  answer is ciphertext of dtype X-RSA-Dtype
+    /rsa/decrypt                  X-RSA-P, X-RSA-Q, X-RSA-E, X-RSA-D
+
+Cipher work runs on a thread pool, never on the event loop. AES bodies of
+at most `BATCH_MAX_BYTES` that arrive while a batch for the same key is
+being computed are coalesced into the next one, so many small requests cost
+one keystream computation. Larger bodies are streamed: read, transformed
+and written back `STREAM_CHUNK_SIZE` bytes at a time with chunked transfer
+encoding. At most `max_in_flight` requests are processed at once; further
+requests are not read until one finishes, which pushes back on clients
+through the socket.
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from aes import AES, ctr_counter_words, STREAM_CHUNK_SIZE
+from instrument import stage
+from encrypt_rsa import cipher_dtype, decrypt_values_crt, encryption_table, RSAPrivateKey
+
+logger = logging.getLogger('service')
+
+MAX_IN_FLIGHT = 64
+# AES bodies up to this size are buffered and coalesced with other requests.
+BATCH_MAX_BYTES = 64 * 1024
+BATCH_MAX_REQUESTS = 256
+# Number of keys whose AES schedule and RSA tables are kept.
+KEY_CACHE_SIZE = 64
+MAX_HEADER_BYTES = 16 * 1024
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 411: 'Length Required',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class KeystreamBatcher:
+    """
+    Coalesces CTR requests for one key. While one batch runs on the executor,
+    new requests queue up; when it finishes they are all XORed with a single
+    `encrypt_words` call over the concatenated counter blocks.
+    """
+
+    def __init__(self, cipher, executor, max_requests=BATCH_MAX_REQUESTS):
+        self.cipher = cipher
+        self.executor = executor
+        self.max_requests = max_requests
+        self._pending = []
+        self._running = False
+
+    async def xor(self, iv, data):
+        """ Returns `data` XORed with the CTR keystream of `iv` from block 0. """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((iv, data, future))
+        if not self._running:
+            self._flush()
+        return await future
+
+    def _flush(self):
+        batch, self._pending = self._pending[:self.max_requests], self._pending[self.max_requests:]
+        if not batch:
+            self._running = False
+            return
+        self._running = True
+        task = asyncio.get_running_loop().run_in_executor(self.executor, self._run, [item[:2] for item in batch])
+        task.add_done_callback(lambda done: self._finish(batch, done))
+
+    def _finish(self, batch, done):
+        for index, (_, _, future) in enumerate(batch):
+            if future.cancelled():
+                continue
+            if done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(done.result()[index])
+        self._flush()
+
+    def _run(self, requests):
+        n_bytes = sum(len(data) for _, data in requests)
+        with stage('service.batch', n_bytes=n_bytes):
+            words = np.concatenate([ctr_counter_words(iv, 0, (len(data) + 15) // 16) for iv, data in requests])
+            keystream = self.cipher.encrypt_words(words).astype('>u4').view(np.uint8).reshape(-1)
+            results = []
+            offset = 0
+            for _, data in requests:
+                results.append(np.bitwise_xor(np.frombuffer(data, dtype=np.uint8),
+                                              keystream[offset:offset + len(data)]).tobytes())
+                offset += (len(data) + 15) // 16 * 16
+            return results
+
+
+class RSADecryptor:
+    """ Streams RSA ciphertext values, carrying partial values between chunks. """
+
+    def __init__(self, private_key, dtype):
+        self.private_key = private_key
+        self.dtype = dtype
+        self._rest = b''
+
+    def update(self, chunk):
+        data = self._rest + bytes(chunk)
+        usable = len(data) - len(data) % self.dtype.itemsize
+        self._rest = data[usable:]
+        ciphertext = np.frombuffer(data[:usable], dtype=self.dtype)
+        return decrypt_values_crt(ciphertext, self.private_key).astype(np.uint8).tobytes()
+
+    def finalize(self):
+        if self._rest:
+            raise HTTPError(400, 'RSA ciphertext length is not a multiple of its value size')
+        return b''
+
+
+def _lru_get(cache, key, build):
+    value = cache.get(key)
+    if value is None:
+        value = cache[key] = build()
+        while len(cache) > KEY_CACHE_SIZE:
+            cache.popitem(last=False)
+    cache.move_to_end(key)
+    return value
+
+
+def _hex_header(headers, name, lengths=None):
+    try:
+        value = bytes.fromhex(headers[name])
+    except (KeyError, ValueError):
+        raise HTTPError(400, f'missing or invalid {name} header')
+    if lengths and len(value) not in lengths:
+        raise HTTPError(400, f'{name} must be {" or ".join(str(n) for n in lengths)} bytes')
+    return value
+
+
+def _int_header(headers, name):
+    try:
+        return int(headers[name], 0)
+    except (KeyError, ValueError):
+        raise HTTPError(400, f'missing or invalid {name} header')
+
+
+def _rsa_dtype(n_modulus):
+    dtype = cipher_dtype(n_modulus)
+    if dtype.hasobject:
+        raise HTTPError(400, 'RSA moduli wider than 64 bits are not supported')
+    return dtype
+
+
+async def read_request(reader):
+    """ Returns (method, path, headers) of the next request, or None at end of stream. """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as exc:
+        if exc.partial.strip():
+            raise HTTPError(400, 'incomplete request head')
+        return None
+    except asyncio.LimitOverrunError:
+        raise HTTPError(413, 'request head too large')
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, path, _ = lines[0].split(' ', 2)
+    except ValueError:
+        raise HTTPError(400, 'malformed request line')
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+    return method, path.split('?', 1)[0], headers
+
+
+async def body_chunks(reader, headers, chunk_size=STREAM_CHUNK_SIZE):
+    """ Yields the request body in chunks of at most `chunk_size` bytes. """
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            if size == 0:
+                await reader.readuntil(b'\r\n')
+                return
+            while size:
+                part = await reader.readexactly(min(size, chunk_size))
+                size -= len(part)
+                yield part
+            await reader.readexactly(2)
+    remaining = int(headers.get('content-length', 0))
+    while remaining:
+        part = await reader.readexactly(min(remaining, chunk_size))
+        remaining -= len(part)
+        yield part
+
+
+def response_head(status, headers):
+    lines = [f'HTTP/1.1 {status} {REASONS[status]}'] + [f'{name}: {value}' for name, value in headers.items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+class EncryptionService:
+    """ The request handler; `start` serves it on TCP or a Unix socket. """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, workers=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='service')
+        self.max_in_flight = max_in_flight
+        self._in_flight = None
+        self._batchers = OrderedDict()
+        self._rsa_tables = OrderedDict()
+        self._rsa_private_keys = OrderedDict()
+
+    async def start(self, host='127.0.0.1', port=8080, path=None):
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        if path:
+            return await asyncio.start_unix_server(self.handle_connection, path=path, limit=MAX_HEADER_BYTES)
+        return await asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER_BYTES)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def _batcher(self, key):
+        # Keyed by digest, like aes.KeyScheduleCache, so raw keys are never dict keys.
+        return _lru_get(self._batchers, hashlib.sha256(key).digest(),
+                        lambda: KeystreamBatcher(AES(key), self.executor))
+
+    def _rsa_private_key(self, headers):
+        """
+        Returns the cached `RSAPrivateKey` of the X-RSA-* headers, so its
+        decryption tables are built once per key rather than per request.
+        """
+        p_prime, q_prime, e, d_private = (_int_header(headers, f'x-rsa-{name}') for name in 'pqed')
+        if min(p_prime, q_prime) < 2 or e < 1 or d_private < 1:
+            raise HTTPError(400, 'X-RSA-P and X-RSA-Q must be greater than 1, X-RSA-E and X-RSA-D positive')
+        digest = hashlib.sha256(f'{p_prime}:{q_prime}:{e}:{d_private}'.encode()).digest()
+        try:
+            return _lru_get(self._rsa_private_keys, digest, lambda: RSAPrivateKey(p_prime, q_prime, e, d_private))
+        except (ValueError, ZeroDivisionError) as exc:
+            raise HTTPError(400, f'invalid RSA private key: {exc}')
+
+    def _transform(self, path, headers):
+        """ Returns (update, finalize, response headers) for a streamed request. """
+        if path in ('/aes/encrypt', '/aes/decrypt'):
+            key = _hex_header(headers, 'x-key', (16, 24, 32))
+            iv = _hex_header(headers, 'x-iv', (16,))
+            stream = self._batcher(key).cipher.ctr_stream(iv)
+            return stream.update, stream.finalize, {}
+        if path == '/rsa/encrypt':
+            e, n_modulus = _int_header(headers, 'x-rsa-e'), _int_header(headers, 'x-rsa-n')
+            if e < 1 or n_modulus < 2:
+                raise HTTPError(400, 'X-RSA-E must be positive and X-RSA-N greater than 1')
+            dtype = _rsa_dtype(n_modulus)
+            table = _lru_get(self._rsa_tables, (e, n_modulus), lambda: encryption_table(e, n_modulus))
+
+            def update(chunk):
+                with stage('rsa.image_encryption', n_bytes=len(chunk)):
+                    return table[np.frombuffer(chunk, dtype=np.uint8)].tobytes()
+            return update, bytes, {'X-RSA-Dtype': dtype.str}
+        if path == '/rsa/decrypt':
+            private_key = self._rsa_private_key(headers)
+            decryptor = RSADecryptor(private_key, _rsa_dtype(private_key.n_modulus))
+            return decryptor.update, decryptor.finalize, {}
+        raise HTTPError(404, f'no endpoint {path}')
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    async with self._in_flight:
+                        keep_alive = await self.handle_request(reader, writer, *request)
+                except HTTPError as exc:
+                    body = (str(exc) + '\n').encode()
+                    writer.write(response_head(exc.status, {'Content-Length': len(body), 'Connection': 'close'}) + body)
+                    keep_alive = False
+                if not keep_alive:
+                    break
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            logger.exception('request failed')
+        finally:
+            writer.close()
+
+    async def handle_request(self, reader, writer, method, path, headers):
+        """ Serves one request and returns whether the connection can be reused. """
+        if method != 'POST':
+            raise HTTPError(405, 'only POST is supported')
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        length = headers.get('content-length')
+        if length is None and headers.get('transfer-encoding', '').lower() != 'chunked':
+            raise HTTPError(411, 'a Content-Length or chunked body is required')
+        if length is not None:
+            try:
+                length = int(length)
+            except ValueError:
+                length = -1
+            if length < 0:
+                raise HTTPError(400, 'invalid Content-Length header')
+
+        if path in ('/aes/encrypt', '/aes/decrypt') and length is not None and length <= BATCH_MAX_BYTES:
+            key = _hex_header(headers, 'x-key', (16, 24, 32))
+            iv = _hex_header(headers, 'x-iv', (16,))
+            body = await reader.readexactly(length)
+            result = await self._batcher(key).xor(iv, body)
+            writer.write(response_head(200, {'Content-Length': len(result)}) + result)
+            await writer.drain()
+            return keep_alive
+
+        update, finalize, extra_headers = self._transform(path, headers)
+        loop = asyncio.get_running_loop()
+        writer.write(response_head(200, {'Transfer-Encoding': 'chunked', **extra_headers}))
+        async for chunk in body_chunks(reader, headers):
+            result = await loop.run_in_executor(self.executor, update, chunk)
+            if result:
+                writer.write(b'%x\r\n%s\r\n' % (len(result), result))
+                # Waits for the client to read before taking the next chunk off the socket.
+                await writer.drain()
+        try:
+            finalize()
+        except HTTPError:
+            # The status line is already sent; dropping the connection marks the response as failed.
+            return False
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        return keep_alive
+
+
+async def serve(host, port, path, max_in_flight, workers):
+    service = EncryptionService(max_in_flight, workers)
+    server = await service.start(host, port, path)
+    logger.info(f'Serving on {path or f"{host}:{port}"}')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local AES/RSA image encryption service.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', help='serve on this Unix socket path instead of TCP')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT)
+    parser.add_argument('--workers', type=int, default=None, help='executor threads')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.max_in_flight, args.workers))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
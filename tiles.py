@@ -0,0 +1,122 @@
+"""
+Tiled container for AES-CTR encrypted images, so a viewer can decrypt only
+the tiles it shows.
+
+Layout (little endian):
+
+    header   magic 'AETI', version, channels, height, width, tile height,
+             tile width, IV (16 bytes), tile count
+    index    (offset, length) per tile, row-major, relative to the payload
+    payload  every tile's raw pixels concatenated and encrypted as one CTR
+             stream with the IV
+
+A tile at payload offset `o` is decrypted with counter `iv + o // 16`, so
+reading a region costs only the tiles it overlaps.
+"""
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from aes import AES
+
+MAGIC = b'AETI'
+VERSION = 1
+HEADER = struct.Struct('<4sBBxxIIII16sI')
+INDEX_ENTRY = struct.Struct('<QQ')
+DEFAULT_TILE_SIZE = 256
+
+
+def _tile_grid(height, width, tile_h, tile_w):
+    """ Yields (y, x, h, w) of every tile, row-major. """
+    for y in range(0, height, tile_h):
+        for x in range(0, width, tile_w):
+            yield y, x, min(tile_h, height - y), min(tile_w, width - x)
+
+
+def write_tiled(path, img, key, iv=None, tile_size=DEFAULT_TILE_SIZE):
+    """
+    Splits the uint8 (H, W[, C]) image `img` into tiles, encrypts them and
+    writes a tiled container to `path`. Returns the IV used.
+    """
+    img = np.asarray(img, dtype=np.uint8)
+    if img.ndim == 2:
+        img = img[:, :, None]
+    height, width, channels = img.shape
+    iv = iv or os.urandom(16)
+    tile_h, tile_w = (tile_size, tile_size) if isinstance(tile_size, int) else tile_size
+
+    grid = list(_tile_grid(height, width, tile_h, tile_w))
+    index = []
+    offset = 0
+    for _, _, h, w in grid:
+        index.append((offset, h * w * channels))
+        offset += h * w * channels
+
+    stream = AES(key).ctr_stream(iv)
+    with open(path, 'wb') as output_file:
+        output_file.write(HEADER.pack(MAGIC, VERSION, channels, height, width, tile_h, tile_w, iv, len(grid)))
+        for entry in index:
+            output_file.write(INDEX_ENTRY.pack(*entry))
+        for y, x, h, w in grid:
+            output_file.write(stream.update(np.ascontiguousarray(img[y:y + h, x:x + w])))
+    return iv
+
+
+class TiledImage:
+    """
+    Read-only view of a tiled container. The file is memory-mapped and only
+    the tiles that are asked for are read and decrypted.
+    """
+
+    def __init__(self, path, key):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.channels, self.height, self.width, self.tile_h, self.tile_w, self.iv, n_tiles = \
+            HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} tiled image')
+        index_start = HEADER.size
+        self.index = [INDEX_ENTRY.unpack_from(self._map, index_start + i * INDEX_ENTRY.size)
+                      for i in range(n_tiles)]
+        self._payload = memoryview(self._map)[index_start + n_tiles * INDEX_ENTRY.size:]
+        self._cipher = AES(key)
+        self.tiles_x = -(-self.width // self.tile_w)
+        self.tiles_y = -(-self.height // self.tile_h)
+
+    @property
+    def shape(self):
+        return self.height, self.width, self.channels
+
+    def read_tile(self, ty, tx):
+        """ Decrypts and returns tile (ty, tx) as a uint8 (h, w, C) array. """
+        offset, length = self.index[ty * self.tiles_x + tx]
+        h = min(self.tile_h, self.height - ty * self.tile_h)
+        w = min(self.tile_w, self.width - tx * self.tile_w)
+        data = self._cipher.decrypt_range(self._payload, self.iv, offset, length)
+        return np.frombuffer(data, dtype=np.uint8).reshape(h, w, self.channels)
+
+    def read_region(self, y, x, h, w):
+        """ Decrypts only the tiles overlapping the region and returns its pixels. """
+        assert 0 <= y and 0 <= x and y + h <= self.height and x + w <= self.width
+        out = np.empty((h, w, self.channels), dtype=np.uint8)
+        for ty in range(y // self.tile_h, -(-(y + h) // self.tile_h)):
+            for tx in range(x // self.tile_w, -(-(x + w) // self.tile_w)):
+                tile = self.read_tile(ty, tx)
+                ty0, tx0 = ty * self.tile_h, tx * self.tile_w
+                y0, y1 = max(y, ty0), min(y + h, ty0 + tile.shape[0])
+                x0, x1 = max(x, tx0), min(x + w, tx0 + tile.shape[1])
+                out[y0 - y:y1 - y, x0 - x:x1 - x] = tile[y0 - ty0:y1 - ty0, x0 - tx0:x1 - tx0]
+        return out
+
+    def close(self):
+        self._payload.release()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()